@@ -0,0 +1,64 @@
+"""命令前缀匹配基准测试
+
+在机器人根目录下执行:
+
+    python -m plugins.Doubao.benchmarks.bench_command_matcher
+
+使用与线上群聊相近的消息组合(绝大多数消息不触发)，对比逐条命令比较的旧实现与前缀树匹配器。
+"""
+import random
+import time
+
+from plugins.Doubao.main import CommandMatcher
+
+COMMANDS = ["#豆包", "#豆", "#doubao", "/豆包", "/db", "/doubao", "豆包", "doubao", "@豆包", "@db", "@doubao", "豆", "db"]
+
+NON_TRIGGERING = [
+    "哈哈哈哈", "今天中午吃什么", "收到", "[图片]", "明天几点开会？", "好的好的", "这个链接打不开",
+    "@张三 你看一下", "6666", "有人一起打游戏吗", "OK", "周末去爬山吧", "刚才那个视频太搞笑了",
+    "Deadline是周五", "谢谢大家", "我到了", "[表情]", "晚安", "下班了下班了",
+]
+
+TRIGGERING = ["豆包 今天星期几", "#豆包 写一首诗", "/db 翻译一下hello", "DB 讲个笑话", "豆 画一只猫", "@Doubao 帮我查一下"]
+
+MESSAGES = 100000
+TRIGGER_RATIO = 0.05
+
+
+def legacy_match(commands: list[str], content: str) -> tuple[bool, str]:
+    """旧版逐条命令比较的实现，作为对比基线"""
+    if not content:
+        return False, content
+    content = content.strip()
+    for cmd in commands:
+        if content.lower().startswith(cmd.lower()):
+            return True, content[len(cmd):].strip()
+        padded_cmd = f"{cmd} "
+        if content.lower().startswith(padded_cmd.lower()):
+            return True, content[len(padded_cmd) - 1:].strip()
+    return False, content
+
+
+def main():
+    rng = random.Random(0)
+    messages = [
+        rng.choice(TRIGGERING) if rng.random() < TRIGGER_RATIO else rng.choice(NON_TRIGGERING)
+        for _ in range(MESSAGES)
+    ]
+    matcher = CommandMatcher(COMMANDS)
+
+    start = time.perf_counter()
+    legacy_hits = sum(legacy_match(COMMANDS, message)[0] for message in messages)
+    legacy_elapsed = time.perf_counter() - start
+
+    start = time.perf_counter()
+    trie_hits = sum(matcher.match(message)[0] for message in messages)
+    trie_elapsed = time.perf_counter() - start
+
+    print(f"消息数: {MESSAGES}, 触发比例: {TRIGGER_RATIO:.0%}")
+    print(f"旧实现: {legacy_elapsed / MESSAGES * 1e6:.2f}us/条, 触发{legacy_hits}条")
+    print(f"前缀树: {trie_elapsed / MESSAGES * 1e6:.2f}us/条, 触发{trie_hits}条")
+
+
+if __name__ == "__main__":
+    main()
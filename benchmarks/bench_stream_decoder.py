@@ -0,0 +1,47 @@
+"""豆包对话流解码器基准测试
+
+在 config.toml 中设置 stream_record_dir 录制真实对话流后，在机器人根目录下执行:
+
+    python -m plugins.Doubao.benchmarks.bench_stream_decoder plugins/Doubao/recordings/*.sse
+
+对每个录制文件按不同数据块大小回放，输出每次解码耗时与事件数。
+"""
+import sys
+import time
+from pathlib import Path
+
+from plugins.Doubao.main import DoubaoStreamDecoder, JSON_BACKEND
+
+CHUNK_SIZES = (64, 1024, 16384)
+ROUNDS = 20
+
+
+def replay(data: bytes, chunk_size: int) -> DoubaoStreamDecoder:
+    """按固定数据块大小回放一段录制的对话流"""
+    decoder = DoubaoStreamDecoder()
+    for i in range(0, len(data), chunk_size):
+        decoder.feed(data[i:i + chunk_size])
+        if decoder.completed:
+            break
+    decoder.finish()
+    return decoder
+
+
+def main(paths: list[str]):
+    if not paths:
+        print(__doc__)
+        return
+    print(f"JSON解析库: {JSON_BACKEND}")
+    for path in paths:
+        data = Path(path).read_bytes()
+        for chunk_size in CHUNK_SIZES:
+            start = time.perf_counter()
+            for _ in range(ROUNDS):
+                decoder = replay(data, chunk_size)
+            elapsed = (time.perf_counter() - start) / ROUNDS
+            print(f"{Path(path).name} 块大小={chunk_size}: {elapsed * 1000:.2f}ms/次, "
+                  f"事件数={decoder.event_count}, 文本长度={len(decoder.text)}, 图片={len(decoder.image_urls)}")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -1,19 +1,1934 @@
 from pathlib import Path
 import random
 import aiohttp
+from aiohttp import web
 import json
-from datetime import datetime
+from datetime import datetime, timedelta
 from loguru import logger
 import uuid
-import io
 from PIL import Image, ImageDraw, ImageFont  # 添加PIL导入用于图像处理和绘制
 import asyncio
 import time
+import functools
+import os
+import gzip
+import shutil
+import sqlite3
+import threading
+import hashlib
+import contextvars
+from collections import OrderedDict, deque
+from urllib.parse import urlsplit
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 
 from WechatAPI import WechatAPIClient
 from utils.decorators import *
 from utils.plugin_base import PluginBase
 
+# 优先使用更快的JSON解析库，未安装时回退到标准库
+try:
+    import orjson
+    _json_loads = orjson.loads
+    JSON_BACKEND = "orjson"
+except ImportError:
+    try:
+        import msgspec
+        _json_loads = msgspec.json.decode
+        JSON_BACKEND = "msgspec"
+    except ImportError:
+        _json_loads = json.loads
+        JSON_BACKEND = "json"
+
+
+class LogSampler:
+    """日志采样器
+    
+    用于每个流事件都可能触发的日志，按rate的比例均匀记录(rate为1时全部记录，为0时全部丢弃)，
+    避免高并发时日志本身成为开销。
+    """
+
+    def __init__(self, rate: float = 1.0):
+        self.rate = rate
+        self._credit = 0.0
+
+    def sample(self) -> bool:
+        """本次是否记录日志"""
+        if self.rate >= 1:
+            return True
+        if self.rate <= 0:
+            return False
+        self._credit += self.rate
+        if self._credit >= 1:
+            self._credit -= 1
+            return True
+        return False
+
+
+# 流事件日志的采样器，采样比例由插件配置log_sample_rate设置
+event_log_sampler = LogSampler()
+
+
+class MetricsRegistry:
+    """进程内指标注册表
+    
+    指标先用register声明类型(counter/gauge/histogram)和说明，之后按名称记录，标签以关键字参数传入。
+    render输出Prometheus文本格式，可通过HTTP接口或定期写入文件导出。
+    """
+
+    DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+    def __init__(self):
+        self._metrics = OrderedDict()  # 名称 -> {"type", "help", "buckets", "samples": {标签元组: 值}}
+
+    def register(self, name: str, kind: str, help_text: str, buckets: tuple = None):
+        """声明指标
+        
+        Args:
+            name: 指标名
+            kind: counter、gauge或histogram
+            help_text: 指标说明
+            buckets: histogram的桶上界(秒)，默认使用DEFAULT_BUCKETS
+        """
+        self._metrics[name] = {
+            "type": kind,
+            "help": help_text,
+            "buckets": tuple(buckets or self.DEFAULT_BUCKETS) if kind == "histogram" else None,
+            "samples": {}
+        }
+
+    def inc(self, name: str, value: float = 1, **labels):
+        """counter增加value"""
+        samples = self._metrics[name]["samples"]
+        key = tuple(sorted(labels.items()))
+        samples[key] = samples.get(key, 0) + value
+
+    def set(self, name: str, value: float, **labels):
+        """设置gauge的当前值"""
+        self._metrics[name]["samples"][tuple(sorted(labels.items()))] = value
+
+    def observe(self, name: str, value: float, **labels):
+        """histogram记录一次观测值"""
+        metric = self._metrics[name]
+        key = tuple(sorted(labels.items()))
+        sample = metric["samples"].get(key)
+        if sample is None:
+            sample = metric["samples"][key] = {"buckets": [0] * len(metric["buckets"]), "sum": 0.0, "count": 0}
+        for i, bound in enumerate(metric["buckets"]):
+            if value <= bound:
+                sample["buckets"][i] += 1
+        sample["sum"] += value
+        sample["count"] += 1
+
+    @staticmethod
+    def _format_labels(labels: tuple, extra: tuple = ()) -> str:
+        items = labels + extra
+        if not items:
+            return ""
+        parts = []
+        for key, value in items:
+            value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+            parts.append(f'{key}="{value}"')
+        return "{" + ",".join(parts) + "}"
+
+    def render(self) -> str:
+        """输出Prometheus文本格式"""
+        lines = []
+        for name, metric in self._metrics.items():
+            lines.append(f"# HELP {name} {metric['help']}")
+            lines.append(f"# TYPE {name} {metric['type']}")
+            for labels, sample in metric["samples"].items():
+                if metric["type"] != "histogram":
+                    lines.append(f"{name}{self._format_labels(labels)} {sample}")
+                    continue
+                for bound, count in zip(metric["buckets"], sample["buckets"]):
+                    lines.append(f"{name}_bucket{self._format_labels(labels, (('le', bound),))} {count}")
+                lines.append(f"{name}_bucket{self._format_labels(labels, (('le', '+Inf'),))} {sample['count']}")
+                lines.append(f"{name}_sum{self._format_labels(labels)} {sample['sum']:.6f}")
+                lines.append(f"{name}_count{self._format_labels(labels)} {sample['count']}")
+        return "\n".join(lines) + "\n"
+
+class DoubaoAccount:
+    """豆包账号(会话)及其运行状态"""
+
+    def __init__(self, name: str, conversation_id: str, section_id: str, cookie: str):
+        self.name = name
+        self.conversation_id = conversation_id
+        self.section_id = section_id
+        self.cookie = cookie
+        self.in_flight = 0  # 正在进行的请求数
+        self.total = 0  # 已完成的请求数
+        self.failures = 0  # 失败的请求数
+        self.error_rate = 0.0  # 指数加权平均错误率
+        self.cooldown_until = 0.0  # 暂停使用截止时间(time.monotonic)
+        self.last_status = None  # 最近一次HTTP状态码
+
+
+class DoubaoAccountPool:
+    """豆包账号池
+    
+    按正在进行的请求数最少(其次错误率最低)分配账号；账号返回非200状态码或错误率
+    超过阈值时暂停使用cooldown秒，所有账号都在暂停中时选择最早恢复的账号。
+    """
+
+    def __init__(self, accounts: list[DoubaoAccount], cooldown: float = 300, error_threshold: float = 0.5, alpha: float = 0.2):
+        self.accounts = accounts
+        self.cooldown = cooldown
+        self.error_threshold = error_threshold
+        self.alpha = alpha  # 错误率的平滑系数
+
+    def acquire(self, preferred: DoubaoAccount = None) -> DoubaoAccount:
+        """选择一个账号并计入正在进行的请求
+        
+        Args:
+            preferred: 优先使用的账号(如用户会话绑定的账号)，不在暂停中时直接使用
+        """
+        now = time.monotonic()
+        if preferred is not None and preferred.cooldown_until <= now:
+            preferred.in_flight += 1
+            return preferred
+        
+        available = [account for account in self.accounts if account.cooldown_until <= now]
+        if not available:
+            available = [min(self.accounts, key=lambda account: account.cooldown_until)]
+        account = min(available, key=lambda account: (account.in_flight, account.error_rate))
+        account.in_flight += 1
+        return account
+
+    def release(self, account: DoubaoAccount, ok: bool, status: int = None):
+        """请求结束后更新账号状态
+        
+        Args:
+            account: acquire返回的账号
+            ok: 请求是否成功，None表示不计入统计(请求被取消，或因处理时限缩短了超时时间)
+            status: HTTP状态码，未收到响应时为None
+        """
+        account.in_flight -= 1
+        if ok is None:
+            return
+        account.total += 1
+        account.last_status = status
+        account.error_rate = account.error_rate * (1 - self.alpha) + (0.0 if ok else self.alpha)
+        if ok:
+            return
+        
+        account.failures += 1
+        if (status is not None and status != 200) or account.error_rate >= self.error_threshold:
+            account.cooldown_until = time.monotonic() + self.cooldown
+            logger.warning(f"豆包账号 {account.name} 暂停使用{self.cooldown}秒: 状态码{status}, 错误率{account.error_rate:.2f}")
+
+    def stats(self) -> list[dict]:
+        """各账号的运行状态"""
+        now = time.monotonic()
+        return [
+            {
+                "name": account.name,
+                "conversation_id": account.conversation_id,
+                "in_flight": account.in_flight,
+                "total": account.total,
+                "failures": account.failures,
+                "error_rate": round(account.error_rate, 3),
+                "cooling_down": account.cooldown_until > now,
+                "last_status": account.last_status
+            }
+            for account in self.accounts
+        ]
+
+
+class CircuitBreaker:
+    """熔断器
+    
+    统计最近window次请求的结果，请求数不少于min_requests且失败率达到failure_rate时熔断，
+    熔断期间直接拒绝请求；reset_timeout秒后进入半开状态，放行half_open_probes个探测请求，
+    探测成功则恢复，失败则再次熔断。
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, name: str, failure_rate: float = 0.5, min_requests: int = 5, window: int = 20,
+                 reset_timeout: float = 30, half_open_probes: int = 1):
+        self.name = name
+        self.failure_rate = failure_rate
+        self.min_requests = min_requests
+        self.reset_timeout = reset_timeout
+        self.half_open_probes = half_open_probes
+        self._state = self.CLOSED
+        self._results = deque(maxlen=window)  # 最近的请求结果，True为成功
+        self._opened_at = 0.0
+        self._probes = 0  # 半开状态下已放行的探测请求数
+        self.rejected = 0  # 熔断期间拒绝的请求数
+        self.trips = 0  # 熔断次数
+
+    @property
+    def state(self) -> str:
+        """当前状态，熔断超时后转为半开"""
+        if self._state == self.OPEN and time.monotonic() - self._opened_at >= self.reset_timeout:
+            self._state = self.HALF_OPEN
+            self._probes = 0
+            logger.info(f"熔断器 {self.name} 进入半开状态，开始探测")
+        return self._state
+
+    @property
+    def available(self) -> bool:
+        """是否可能放行请求(不占用探测名额)"""
+        state = self.state
+        return state == self.CLOSED or (state == self.HALF_OPEN and self._probes < self.half_open_probes)
+
+    def allow(self) -> bool:
+        """请求前调用，放行时调用方必须在请求结束后调用record"""
+        state = self.state
+        if state == self.CLOSED:
+            return True
+        if state == self.HALF_OPEN and self._probes < self.half_open_probes:
+            self._probes += 1
+            return True
+        self.rejected += 1
+        return False
+
+    def record(self, ok: bool):
+        """记录一次请求的结果"""
+        if self._state == self.HALF_OPEN:
+            if ok:
+                self._state = self.CLOSED
+                self._results.clear()
+                logger.info(f"熔断器 {self.name} 探测成功，恢复正常")
+            else:
+                self._trip()
+            return
+        
+        self._results.append(ok)
+        if self._state == self.CLOSED and len(self._results) >= self.min_requests:
+            failures = self._results.count(False)
+            if failures / len(self._results) >= self.failure_rate:
+                self._trip()
+
+    def cancel(self):
+        """放行的请求被取消且不计入统计时调用，归还半开状态的探测名额"""
+        if self._state == self.HALF_OPEN and self._probes > 0:
+            self._probes -= 1
+
+    def _trip(self):
+        self._state = self.OPEN
+        self._opened_at = time.monotonic()
+        self._results.clear()
+        self.trips += 1
+        logger.warning(f"熔断器 {self.name} 已熔断，{self.reset_timeout}秒后重新探测")
+
+    def stats(self) -> dict:
+        """熔断器状态"""
+        return {
+            "name": self.name,
+            "state": self.state,
+            "recent_requests": len(self._results),
+            "recent_failures": self._results.count(False),
+            "rejected": self.rejected,
+            "trips": self.trips
+        }
+
+
+class ConversationImagePoller:
+    """单个会话的图片生成结果轮询器
+    
+    同一会话中所有等待图片的请求共用一个轮询任务，每次的轮询结果分发给全部等待者。
+    轮询间隔从initial_delay开始按指数退避增长到max_delay，并加入随机抖动；
+    等待的消息中所有图片都完成(状态2)后立即返回。
+    """
+
+    def __init__(self, fetch_messages, initial_delay: float = 1.0, max_delay: float = 5.0):
+        self._fetch_messages = fetch_messages
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+        self._waiters = {}  # future -> [消息ID, 已完成的图片URL]
+        self._task = None
+        self.poll_count = 0
+
+    @property
+    def idle(self) -> bool:
+        """是否没有等待者"""
+        return not self._waiters
+
+    async def wait(self, message_id: str, timeout: float) -> list[str]:
+        """等待指定消息的图片生成完成
+        
+        Args:
+            message_id: 消息ID，为None时接受会话中任意已完成的图片
+            timeout: 最长等待时间(秒)
+            
+        Returns:
+            list[str]: 图片URL列表，超时时返回已完成的部分
+        """
+        future = asyncio.get_running_loop().create_future()
+        waiter = [message_id, []]
+        self._waiters[future] = waiter
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+        try:
+            return await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            return waiter[1]
+        finally:
+            self._waiters.pop(future, None)
+
+    async def _run(self):
+        delay = self.initial_delay
+        while self._waiters:
+            await asyncio.sleep(delay * random.uniform(0.8, 1.2))
+            delay = min(delay * 2, self.max_delay)
+            if not self._waiters:
+                break
+            
+            try:
+                messages = await self._fetch_messages()
+            except Exception as e:
+                logger.error(f"轮询请求异常: {e}")
+                continue
+            self.poll_count += 1
+            logger.debug("第{}次轮询图片结果，等待者{}个", self.poll_count, len(self._waiters))
+            
+            # 解析每条消息中已完成的图片和未完成的数量
+            results = {}
+            for msg in messages:
+                decoder = DoubaoStreamDecoder()
+                decoder.handle_message(msg)
+                if decoder.image_urls or decoder.pending_images:
+                    results[msg.get("message_id")] = (decoder.image_urls, decoder.pending_images)
+            
+            for future, waiter in list(self._waiters.items()):
+                if future.done():
+                    continue
+                message_id = waiter[0]
+                if message_id is not None:
+                    urls, pending = results.get(message_id, ([], 1))
+                else:
+                    # 不知道消息ID时，汇总会话中所有已完成的图片
+                    urls = [url for image_urls, _ in results.values() for url in image_urls]
+                    pending = sum(pending for _, pending in results.values())
+                waiter[1] = urls
+                if urls and not pending:
+                    future.set_result(urls)
+
+
+# 下载豆包生成图片时使用的请求头
+IMAGE_REQUEST_HEADERS = {
+    "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/133.0.0.0 Safari/537.36",
+    "Accept": "image/webp,image/apng,image/*,*/*;q=0.8",
+    "Referer": "https://www.doubao.com/"
+}
+
+def write_file_atomic(path: Path, text: str):
+    """先写临时文件再替换，避免写入中断导致文件损坏，读取方也不会读到写了一半的文件"""
+    tmp_path = path.with_suffix(".tmp")
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+
+
+class DailyQuotaStore:
+    """每日对话次数存储
+    
+    计数保存在内存中，日期变化时自动清零。计数的检查和累加之间没有await，
+    在事件循环中是原子的；修改累计到flush_every次或调用flush时才写入文件。
+    文件格式与旧版user_limits.json相同({日期_用户ID: 次数})。
+    """
+
+    def __init__(self, path: Path, flush_every: int = 20):
+        self.path = path
+        self.flush_every = flush_every
+        self._day = datetime.now().strftime('%Y-%m-%d')
+        self._counts = {}
+        self._dirty = 0
+        self._flush_lock = asyncio.Lock()
+        self._load()
+
+    def _load(self):
+        try:
+            if not self.path.exists():
+                return
+            with open(self.path, "r", encoding="utf-8") as f:
+                limits = json.load(f)
+            # 只保留今天的数据
+            prefix = f"{self._day}_"
+            for key, count in limits.items():
+                if key.startswith(prefix):
+                    self._counts[key[len(prefix):]] = count
+        except Exception as e:
+            logger.error(f"加载用户限制文件失败: {e}")
+
+    def _rollover(self):
+        today = datetime.now().strftime('%Y-%m-%d')
+        if today != self._day:
+            self._day = today
+            self._counts.clear()
+            self._dirty += 1
+
+    def try_consume(self, user_id: str, limit: int) -> bool:
+        """未超出限制时计入一次
+        
+        Args:
+            user_id: 用户ID
+            limit: 每日限制次数
+            
+        Returns:
+            bool: 是否允许对话
+        """
+        self._rollover()
+        count = self._counts.get(user_id, 0)
+        if count >= limit:
+            return False
+        self._counts[user_id] = count + 1
+        self._dirty += 1
+        return True
+
+    def refund(self, user_id: str):
+        """退还一次计数(如请求未被处理)"""
+        count = self._counts.get(user_id, 0)
+        if count > 0:
+            self._counts[user_id] = count - 1
+            self._dirty += 1
+
+    def used(self, user_id: str) -> int:
+        """今日已使用次数"""
+        self._rollover()
+        return self._counts.get(user_id, 0)
+
+    def remaining(self, user_id: str, limit: int) -> int:
+        """今日剩余次数"""
+        return max(0, limit - self.used(user_id))
+
+    @property
+    def needs_flush(self) -> bool:
+        """未写入文件的修改是否已达到阈值"""
+        return self._dirty >= self.flush_every
+
+    async def flush(self):
+        """将当前计数写入文件(在线程中执行文件IO)"""
+        if not self._dirty:
+            return
+        async with self._flush_lock:
+            if not self._dirty:
+                return
+            snapshot = {f"{self._day}_{user_id}": count for user_id, count in self._counts.items()}
+            self._dirty = 0
+            try:
+                await asyncio.to_thread(self._write, snapshot)
+            except Exception as e:
+                self._dirty += 1
+                logger.error(f"保存用户限制文件失败: {e}")
+
+    def _write(self, snapshot: dict):
+        write_file_atomic(self.path, json.dumps(snapshot, ensure_ascii=False))
+
+
+class ImageSelectionStore:
+    """每个(群, 用户)最近一次生成的图片，供「查看图片 序号」使用
+    
+    条目保存在TTLCache中，超过ttl未更新或用户数超过max_users时淘汰，内存占用有上限。
+    有修改时由flush写入文件(记录每个条目的到期时间)，重启后恢复仍未过期的条目。
+    """
+
+    def __init__(self, path: Path, ttl: float = 86400, max_users: int = 1000):
+        self.path = path
+        self._cache = TTLCache(ttl, max_users)
+        self._dirty = False
+        self._flush_lock = asyncio.Lock()
+        self._load()
+
+    @staticmethod
+    def key(from_id: str, room_id: str = "") -> str:
+        """条目键，同一用户在不同群中的图片互不覆盖"""
+        return f"{room_id}:{from_id}" if room_id else from_id
+
+    def _load(self):
+        try:
+            if not self.path.exists():
+                return
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            now = time.time()
+            for key, item in data.items():
+                if item["expires_at"] > now:
+                    self._cache.set(key, item["images"], ttl=item["expires_at"] - now)
+        except Exception as e:
+            logger.error(f"加载图片选择记录失败: {e}")
+
+    def get(self, from_id: str, room_id: str = "") -> list[dict]:
+        """读取用户最近一次生成的图片信息，不存在或已过期时返回None"""
+        return self._cache.get(self.key(from_id, room_id))
+
+    def set(self, from_id: str, room_id: str, images: list[dict]):
+        """记录用户最近一次生成的图片信息"""
+        self._cache.set(self.key(from_id, room_id), [
+            {key: image_info[key] for key in ("number", "path", "url", "description")}
+            for image_info in images
+        ])
+        self._dirty = True
+
+    def mark_dirty(self):
+        """条目中的图片信息被修改后调用"""
+        self._dirty = True
+
+    async def flush(self):
+        """将未过期的条目写入文件(在线程中执行文件IO)"""
+        if not self._dirty:
+            return
+        async with self._flush_lock:
+            if not self._dirty:
+                return
+            now = time.time()
+            snapshot = {key: {"expires_at": now + ttl, "images": images} for key, images, ttl in self._cache.items()}
+            self._dirty = False
+            try:
+                await asyncio.to_thread(self._write, snapshot)
+            except Exception as e:
+                self._dirty = True
+                logger.error(f"保存图片选择记录失败: {e}")
+
+    def _write(self, snapshot: dict):
+        write_file_atomic(self.path, json.dumps(snapshot, ensure_ascii=False))
+
+
+class ChatHistoryWriter:
+    """聊天记录后台写入器
+    
+    记录先放入队列，由后台任务按条数或时间阈值批量交给存储后端写入，写入在线程中执行。
+    """
+
+    _CLOSE = object()  # 关闭标记
+
+    def __init__(self, store, batch_size: int = 50, flush_interval: float = 5.0, max_queue_size: int = 10000):
+        self.store = store
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._queue = asyncio.Queue(maxsize=max_queue_size)
+        self._task = None
+
+    def write(self, record: dict):
+        """将一条记录放入写入队列
+        
+        Args:
+            record: 聊天记录，timestamp字段为ISO格式时间
+        """
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+        try:
+            self._queue.put_nowait(record)
+        except asyncio.QueueFull:
+            logger.error("聊天记录写入队列已满，丢弃一条记录")
+
+    async def close(self):
+        """写入队列中剩余的全部记录并停止后台任务"""
+        if self._task is not None and not self._task.done():
+            await self._queue.put(self._CLOSE)
+            await self._task
+        self._task = None
+        await asyncio.to_thread(self.store.close)
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            record = await self._queue.get()
+            if record is self._CLOSE:
+                return
+            
+            # 收集一批记录，达到条数或时间阈值时写入
+            batch = [record]
+            closing = False
+            deadline = loop.time() + self.flush_interval
+            while len(batch) < self.batch_size:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                try:
+                    record = await asyncio.wait_for(self._queue.get(), remaining)
+                except asyncio.TimeoutError:
+                    break
+                if record is self._CLOSE:
+                    closing = True
+                    break
+                batch.append(record)
+            
+            try:
+                await asyncio.to_thread(self.store.write_batch, batch)
+            except Exception as e:
+                logger.error(f"写入聊天记录失败({len(batch)}条): {e}")
+            if closing:
+                return
+
+
+class JsonlHistoryStore:
+    """JSONL聊天记录存储
+    
+    当前文件只保存当天的记录，跨天时轮转为 <文件名>_<日期>.jsonl，可选gzip压缩。
+    """
+
+    def __init__(self, path: Path, compress: bool = True):
+        self.path = path
+        self.compress = compress
+        self._current_day = None
+
+    def write_batch(self, batch: list[dict]):
+        """追加一批记录"""
+        if self._current_day is None and self.path.exists():
+            self._current_day = datetime.fromtimestamp(self.path.stat().st_mtime).strftime('%Y-%m-%d')
+        
+        lines = []
+        for record in batch:
+            day = record["timestamp"][:10]
+            if self._current_day and day > self._current_day:
+                self._append(lines)
+                lines = []
+                self._rotate(self._current_day)
+            if not self._current_day or day > self._current_day:
+                self._current_day = day
+            lines.append(json.dumps(record, ensure_ascii=False) + "\n")
+        self._append(lines)
+
+    def close(self):
+        pass
+
+    def _append(self, lines: list[str]):
+        if lines:
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write("".join(lines))
+
+    def _rotate(self, day: str):
+        if not self.path.exists():
+            return
+        target = self.path.with_name(f"{self.path.stem}_{day}{self.path.suffix}")
+        index = 1
+        while target.exists() or target.with_name(target.name + ".gz").exists():
+            target = self.path.with_name(f"{self.path.stem}_{day}_{index}{self.path.suffix}")
+            index += 1
+        os.replace(self.path, target)
+        logger.info(f"聊天记录已轮转: {target.name}")
+        
+        if self.compress:
+            try:
+                with open(target, "rb") as src, gzip.open(target.with_name(target.name + ".gz"), "wb") as dst:
+                    shutil.copyfileobj(src, dst)
+                target.unlink()
+            except Exception as e:
+                logger.error(f"压缩聊天记录失败: {e}")
+
+
+class SqliteHistoryStore:
+    """SQLite聊天记录存储
+    
+    按(from_id, timestamp)建立索引，带图片的记录另有部分索引，
+    按用户查询近期记录和最近一次生成的图片时无需扫描全部数据。
+    方法均为同步调用，由调用方放到线程中执行。
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(path), check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS chat_history (
+                id INTEGER PRIMARY KEY,
+                timestamp TEXT NOT NULL,
+                from_id TEXT NOT NULL,
+                prompt TEXT,
+                response TEXT,
+                images TEXT,
+                image_details TEXT,
+                image_count INTEGER NOT NULL DEFAULT 0
+            );
+            CREATE INDEX IF NOT EXISTS idx_chat_history_user_time ON chat_history (from_id, timestamp);
+            CREATE INDEX IF NOT EXISTS idx_chat_history_time ON chat_history (timestamp);
+            CREATE INDEX IF NOT EXISTS idx_chat_history_user_images ON chat_history (from_id, timestamp) WHERE image_count > 0;
+        """)
+        self._conn.commit()
+
+    def write_batch(self, batch: list[dict]):
+        """在一个事务中写入一批记录"""
+        rows = [
+            (
+                record["timestamp"],
+                record["from_id"],
+                record.get("prompt", ""),
+                record.get("response", ""),
+                json.dumps(record.get("images") or [], ensure_ascii=False),
+                json.dumps(record.get("image_details") or [], ensure_ascii=False),
+                len(record.get("images") or [])
+            )
+            for record in batch
+        ]
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT INTO chat_history (timestamp, from_id, prompt, response, images, image_details, image_count) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                rows
+            )
+
+    def recent(self, from_id: str, since: str = "", limit: int = 50) -> list[dict]:
+        """查询用户在since之后的记录，按时间倒序
+        
+        Args:
+            from_id: 用户ID
+            since: ISO格式起始时间，为空时不限制
+            limit: 最多返回条数
+        """
+        with self._lock:
+            cursor = self._conn.execute(
+                "SELECT timestamp, from_id, prompt, response, images, image_details FROM chat_history "
+                "WHERE from_id = ? AND timestamp >= ? ORDER BY timestamp DESC LIMIT ?",
+                (from_id, since, limit)
+            )
+            rows = cursor.fetchall()
+        return [self._to_record(row) for row in rows]
+
+    def latest_images(self, from_id: str) -> list[dict]:
+        """查询用户最近一次带图片记录的图片详细信息"""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT image_details FROM chat_history "
+                "WHERE from_id = ? AND image_count > 0 ORDER BY timestamp DESC LIMIT 1",
+                (from_id,)
+            ).fetchone()
+        return json.loads(row[0]) if row and row[0] else []
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    @staticmethod
+    def _to_record(row) -> dict:
+        timestamp, from_id, prompt, response, images, image_details = row
+        return {
+            "timestamp": timestamp,
+            "from_id": from_id,
+            "prompt": prompt,
+            "response": response,
+            "images": json.loads(images) if images else [],
+            "image_details": json.loads(image_details) if image_details else []
+        }
+
+
+# 只有图片没有文本时的默认回复
+DEFAULT_IMAGE_REPLY = "我已经为您生成了图片，请查看。"
+
+
+class TTLCache:
+    """带过期时间和容量上限的字典
+    
+    条目默认使用self.ttl，写入时可为单个条目指定TTL。条目按最近写入/访问的顺序排列，
+    evict()只从最旧的一端淘汰过期和超出容量的条目，开销与淘汰数量成正比；
+    位于未过期条目之后的过期条目在读取时判断为不存在，之后再被淘汰。
+    """
+
+    def __init__(self, ttl: float, max_size: int):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._data = OrderedDict()  # key -> (过期时间, 值)
+
+    def get(self, key, default=None, touch: bool = False):
+        """读取条目
+        
+        Args:
+            key: 键
+            default: 不存在或已过期时的返回值
+            touch: 是否刷新过期时间
+        """
+        item = self._data.get(key)
+        if item is None:
+            return default
+        now = time.monotonic()
+        if item[0] <= now:
+            del self._data[key]
+            return default
+        if touch:
+            self._data[key] = (now + self.ttl, item[1])
+            self._data.move_to_end(key)
+        return item[1]
+
+    def set(self, key, value, ttl: float = None):
+        """写入条目并刷新过期时间
+        
+        Args:
+            key: 键
+            value: 值
+            ttl: 该条目的有效期(秒)，默认使用self.ttl
+        """
+        self._data[key] = (time.monotonic() + (self.ttl if ttl is None else ttl), value)
+        self._data.move_to_end(key)
+        self.evict()
+
+    def pop(self, key, default=None):
+        """删除条目"""
+        item = self._data.pop(key, None)
+        return default if item is None else item[1]
+
+    def evict(self):
+        """淘汰过期和超出容量的条目"""
+        now = time.monotonic()
+        while self._data:
+            key, (expires_at, _) = next(iter(self._data.items()))
+            if expires_at > now and len(self._data) <= self.max_size:
+                break
+            del self._data[key]
+
+    def items(self) -> list[tuple]:
+        """未过期的条目列表，按从旧到新排列
+        
+        Returns:
+            list[tuple]: (键, 值, 剩余有效期(秒))
+        """
+        self.evict()
+        now = time.monotonic()
+        return [(key, value, expires_at - now) for key, (expires_at, value) in self._data.items() if expires_at > now]
+
+    def __contains__(self, key) -> bool:
+        sentinel = object()
+        return self.get(key, sentinel) is not sentinel
+
+    def __len__(self) -> int:
+        self.evict()
+        return len(self._data)
+
+
+class FairRequestScheduler:
+    """调用豆包前的准入控制和公平调度
+    
+    全局最多max_concurrent个请求同时执行，其余请求排队。排队按群聊(私聊按用户)分组，
+    组内再按用户分组，名额空出时在群之间、群内用户之间轮流分配，管理员的请求优先。
+    排队总数或单个用户的排队数超过上限时直接拒绝，管理员不受排队上限限制。
+    """
+
+    def __init__(self, max_concurrent: int = 4, max_queue_depth: int = 20, max_queued_per_user: int = 2):
+        self.max_concurrent = max_concurrent
+        self.max_queue_depth = max_queue_depth
+        self.max_queued_per_user = max_queued_per_user
+        self.running = 0  # 正在执行的请求数
+        self.queued = 0  # 排队中的请求数
+        self.rejected = 0  # 被拒绝的请求数
+        self._admin_waiters = deque()
+        self._lanes = OrderedDict()  # 群ID -> OrderedDict(用户ID -> deque[Future])
+        self._user_queued = {}  # 用户ID -> 排队数
+
+    async def acquire(self, group_id: str, user_id: str, is_admin: bool = False) -> bool:
+        """获取执行名额，需要时排队等待
+        
+        Args:
+            group_id: 群聊ID，私聊时为用户ID
+            user_id: 用户ID
+            is_admin: 是否为管理员
+            
+        Returns:
+            bool: 是否获得名额，被拒绝时返回False
+        """
+        if self.running < self.max_concurrent and not self.queued:
+            self.running += 1
+            return True
+        
+        if not is_admin and (self.queued >= self.max_queue_depth
+                             or self._user_queued.get(user_id, 0) >= self.max_queued_per_user):
+            self.rejected += 1
+            return False
+        
+        future = asyncio.get_running_loop().create_future()
+        if is_admin:
+            self._admin_waiters.append(future)
+        else:
+            self._lanes.setdefault(group_id, OrderedDict()).setdefault(user_id, deque()).append(future)
+            self._user_queued[user_id] = self._user_queued.get(user_id, 0) + 1
+        self.queued += 1
+        
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # 已分配名额但调用方被取消，归还名额
+                self.release()
+            else:
+                self._remove(future, group_id, user_id, is_admin)
+            raise
+        return True
+
+    def release(self):
+        """归还执行名额，并分配给下一个排队的请求"""
+        self.running -= 1
+        while self.running < self.max_concurrent:
+            future = self._next_waiter()
+            if future is None:
+                break
+            if not future.done():
+                self.running += 1
+                future.set_result(True)
+
+    def _next_waiter(self):
+        if self._admin_waiters:
+            self.queued -= 1
+            return self._admin_waiters.popleft()
+        if not self._lanes:
+            return None
+        
+        # 取第一个群中第一个用户的请求，然后把该用户和该群移到队尾
+        group_id, users = next(iter(self._lanes.items()))
+        user_id, waiters = next(iter(users.items()))
+        future = waiters.popleft()
+        self.queued -= 1
+        self._user_queued[user_id] -= 1
+        if not self._user_queued[user_id]:
+            del self._user_queued[user_id]
+        
+        if waiters:
+            users.move_to_end(user_id)
+        else:
+            del users[user_id]
+        if users:
+            self._lanes.move_to_end(group_id)
+        else:
+            del self._lanes[group_id]
+        return future
+
+    def _remove(self, future, group_id: str, user_id: str, is_admin: bool):
+        if is_admin:
+            if future in self._admin_waiters:
+                self._admin_waiters.remove(future)
+                self.queued -= 1
+            return
+        users = self._lanes.get(group_id)
+        waiters = users.get(user_id) if users else None
+        if not waiters or future not in waiters:
+            return
+        waiters.remove(future)
+        self.queued -= 1
+        self._user_queued[user_id] -= 1
+        if not self._user_queued[user_id]:
+            del self._user_queued[user_id]
+        if not waiters:
+            del users[user_id]
+            if not users:
+                del self._lanes[group_id]
+
+    def stats(self) -> dict:
+        """调度器状态"""
+        return {
+            "running": self.running,
+            "queued": self.queued,
+            "rejected": self.rejected,
+            "max_concurrent": self.max_concurrent
+        }
+
+
+# 当前消息的处理截止时间(time.monotonic())，由消息处理入口设置，None表示不限时
+_request_deadline = contextvars.ContextVar("doubao_request_deadline", default=None)
+
+
+def time_left(limit: float = None) -> float:
+    """距当前消息处理截止时间的剩余秒数
+    
+    Args:
+        limit: 返回值上限，为None时不限
+        
+    Returns:
+        float: 剩余秒数(不小于0)，未设置截止时间时返回limit
+    """
+    deadline = _request_deadline.get()
+    if deadline is None:
+        return limit
+    remaining = max(deadline - time.monotonic(), 0)
+    return remaining if limit is None else min(remaining, limit)
+
+
+def timeout_cut_by_deadline(timeout: float, limit: float) -> bool:
+    """判断请求的超时时间是否被处理时限明显缩短(不足正常超时时间的一半)
+    
+    这种情况下的超时主要由排队等待造成，不算上游故障，不计入熔断和账号统计。
+    
+    Args:
+        timeout: 实际使用的超时时间，未设置截止时间时为None
+        limit: 不受处理时限影响时的超时时间，为0或None时视为不限
+    """
+    if timeout is None or not limit:
+        return False
+    return timeout < limit / 2
+
+
+def normalize_prompt(prompt: str) -> str:
+    """规范化提示词(忽略大小写、合并空白)，用于缓存和请求合并"""
+    return " ".join(prompt.casefold().split())
+
+
+class SingleFlight:
+    """请求合并
+    
+    相同键的并发调用只执行一次，其余调用等待并共享同一结果(或异常)；
+    执行结束后移除该键，之后的调用会重新执行。
+    """
+
+    def __init__(self):
+        self._calls = {}  # key -> asyncio.Task
+        self.shared = 0  # 共享结果的调用次数
+
+    async def do(self, key, func):
+        """执行或加入相同键的调用
+        
+        Args:
+            key: 合并键
+            func: 无参数的协程函数
+            
+        Returns:
+            func的返回值
+        """
+        task = self._calls.get(key)
+        if task is not None:
+            self.shared += 1
+            logger.opt(lazy=True).debug("合并进行中的相同请求: {}", lambda: str(key)[:50])
+            return await asyncio.shield(task)
+        
+        task = asyncio.ensure_future(func())
+        self._calls[key] = task
+        try:
+            # 发起者被取消时不影响其他等待者
+            return await asyncio.shield(task)
+        finally:
+            if self._calls.get(key) is task:
+                del self._calls[key]
+
+
+class ResponseCache:
+    """回复缓存
+    
+    每个条目有独立的过期时间，按最近使用顺序淘汰，同时限制条数和文本占用的字节数，
+    并统计命中/未命中次数。
+    """
+
+    def __init__(self, ttl: float = 300, max_entries: int = 500, max_bytes: int = 2 * 1024 * 1024):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._data = OrderedDict()  # key -> (过期时间, 回复文本, 字节数)
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: str) -> str:
+        """读取缓存，未命中或已过期时返回None"""
+        item = self._data.get(key)
+        if item is None or item[0] <= time.monotonic():
+            if item is not None:
+                self._remove(key)
+            self.misses += 1
+            return None
+        self._data.move_to_end(key)
+        self.hits += 1
+        return item[1]
+
+    def set(self, key: str, text: str, ttl: float = None):
+        """写入缓存
+        
+        Args:
+            key: 缓存键
+            text: 回复文本
+            ttl: 该条目的有效期(秒)，默认使用self.ttl
+        """
+        size = len(text.encode("utf-8"))
+        if size > self.max_bytes:
+            return
+        if key in self._data:
+            self._remove(key)
+        self._data[key] = (time.monotonic() + (self.ttl if ttl is None else ttl), text, size)
+        self._bytes += size
+        while len(self._data) > self.max_entries or self._bytes > self.max_bytes:
+            self._remove(next(iter(self._data)))
+
+    def _remove(self, key: str):
+        _, _, size = self._data.pop(key)
+        self._bytes -= size
+
+    def stats(self) -> dict:
+        """缓存统计信息"""
+        total = self.hits + self.misses
+        return {
+            "entries": len(self._data),
+            "bytes": self._bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 3) if total else 0.0
+        }
+
+
+class ImageFileCache:
+    """按内容寻址的图片文件缓存
+    
+    文件以内容的sha256命名(prefix + 摘要 + .jpg)，内容相同的图片只保存一份；同时记录图片URL
+    (去掉签名参数)到文件的映射，已缓存的URL无需再次下载。内存索引记录每个文件的大小和最近访问时间，
+    新文件加入时按最近最少使用的顺序逐个淘汰，使文件数和总字节数不超过限制，不需要扫描目录。
+    """
+
+    def __init__(self, directory: Path, prefix: str = "doubao_img_", max_files: int = 25, max_bytes: int = 200 * 1024 * 1024):
+        self.directory = Path(directory)
+        self.prefix = prefix
+        self.max_files = max_files
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # 摘要 -> {"path", "size", "atime", "urls"}，按最近访问排序
+        self._urls = {}  # URL键 -> 摘要
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def url_key(url: str) -> str:
+        """URL的缓存键，去掉查询参数(签名和过期时间)"""
+        parts = urlsplit(url)
+        return f"{parts.netloc}{parts.path}"
+
+    def path_for(self, digest: str) -> Path:
+        """摘要对应的文件路径"""
+        return self.directory / f"{self.prefix}{digest}.jpg"
+
+    def get(self, url: str) -> str:
+        """查找URL对应的已缓存文件
+        
+        Returns:
+            str: 文件路径，未缓存或文件已被删除时返回None
+        """
+        digest = self._urls.get(self.url_key(url))
+        entry = self._entries.get(digest) if digest else None
+        if entry is None or not os.path.exists(entry["path"]):
+            if entry is not None:
+                self._remove(digest)
+            self.misses += 1
+            return None
+        self._touch(digest)
+        self.hits += 1
+        return entry["path"]
+
+    def add(self, url: str, temp_path: Path, digest: str, size: int) -> str:
+        """把下载好的临时文件加入缓存
+        
+        Args:
+            url: 图片URL，为None时不记录URL映射
+            temp_path: 临时文件路径，加入后被移动或删除
+            digest: 文件内容的sha256
+            size: 文件字节数
+            
+        Returns:
+            str: 缓存中的文件路径
+        """
+        entry = self._entries.get(digest)
+        if entry is not None and os.path.exists(entry["path"]):
+            # 内容相同的图片已存在，丢弃新文件
+            Path(temp_path).unlink(missing_ok=True)
+            self._touch(digest)
+        else:
+            path = self.path_for(digest)
+            os.replace(temp_path, path)
+            if entry is not None:
+                self._remove(digest)
+            entry = self._insert(digest, str(path), size)
+        
+        if url:
+            key = self.url_key(url)
+            self._urls[key] = digest
+            entry["urls"].add(key)
+        self._evict(keep=digest)
+        return entry["path"]
+
+    def add_file(self, path: str):
+        """登记一个已在缓存目录中的文件(如网格图片)，以文件名作为键"""
+        path = Path(path)
+        key = path.stem[len(self.prefix):] if path.stem.startswith(self.prefix) else path.stem
+        if key in self._entries:
+            self._remove(key)
+        self._insert(key, str(path), path.stat().st_size)
+        self._evict(keep=key)
+
+    async def load(self):
+        """扫描缓存目录建立索引并淘汰超出限制的文件，启动时调用一次"""
+        files = await asyncio.to_thread(self._scan)
+        
+        # 目录中已有的文件都早于运行期间加入的文件，按修改时间从新到旧依次放到最前面
+        for mtime, path, size in reversed(files):
+            key = path.stem[len(self.prefix):]
+            if key not in self._entries:
+                self._insert(key, str(path), size, atime=mtime)
+                self._entries.move_to_end(key, last=False)
+        self._evict()
+        logger.info(f"图片缓存索引已建立: {len(self._entries)}个文件, {self._bytes / 1024 / 1024:.1f}MB")
+
+    def _scan(self) -> list[tuple]:
+        """列出缓存目录中的文件，按修改时间从旧到新排序"""
+        files = []
+        for path in self.directory.glob(f"{self.prefix}*.jpg"):
+            try:
+                stat = path.stat()
+            except OSError:
+                continue
+            files.append((stat.st_mtime, path, stat.st_size))
+        files.sort(key=lambda item: item[0])
+        return files
+
+    def _insert(self, digest: str, path: str, size: int, atime: float = None) -> dict:
+        entry = {"path": path, "size": size, "atime": atime or time.time(), "urls": set()}
+        self._entries[digest] = entry
+        self._bytes += size
+        return entry
+
+    def _touch(self, digest: str):
+        self._entries[digest]["atime"] = time.time()
+        self._entries.move_to_end(digest)
+
+    def _remove(self, digest: str) -> dict:
+        entry = self._entries.pop(digest)
+        self._bytes -= entry["size"]
+        for key in entry["urls"]:
+            if self._urls.get(key) == digest:
+                del self._urls[key]
+        return entry
+
+    def _evict(self, keep: str = None):
+        """按最近最少使用顺序删除文件，直到不超过数量和字节数限制"""
+        while len(self._entries) > self.max_files or self._bytes > self.max_bytes:
+            digest = next(iter(self._entries))
+            if digest == keep:
+                break
+            entry = self._remove(digest)
+            self.evictions += 1
+            try:
+                Path(entry["path"]).unlink(missing_ok=True)
+                logger.debug(f"删除缓存图片: {entry['path']}")
+            except Exception as e:
+                logger.error(f"删除缓存图片失败: {e}")
+
+    def stats(self) -> dict:
+        """缓存统计信息"""
+        return {
+            "files": len(self._entries),
+            "bytes": self._bytes,
+            "urls": len(self._urls),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions
+        }
+
+
+class CommandMatcher:
+    """命令前缀匹配器
+    
+    加载配置时将命令列表编译为忽略大小写的前缀树，匹配时只需从头扫描一次消息，
+    并返回最长的匹配命令，因此"豆"不会抢先匹配"豆包"，与命令的配置顺序无关。
+    """
+
+    _END = ""  # 命令结束标记，单个字符不会是空字符串
+
+    def __init__(self, commands: list[str]):
+        self._root = {}
+        for cmd in commands:
+            # 配置中带空格的命令(如"#豆包 ")与不带空格的命令等价
+            cmd = cmd.strip()
+            if not cmd:
+                continue
+            node = self._root
+            for ch in cmd.casefold():
+                node = node.setdefault(ch, {})
+            node[self._END] = True
+
+    def match(self, content: str) -> tuple[bool, str]:
+        """
+        匹配消息开头的命令
+        
+        Args:
+            content: 消息内容
+            
+        Returns:
+            (是否触发命令, 去除命令前缀后的内容)
+        """
+        if not content:
+            return False, content
+        
+        content = content.strip()
+        node = self._root
+        end = 0
+        for i, ch in enumerate(content):
+            # 少数字符casefold后会变成多个字符
+            for folded in ch.casefold():
+                node = node.get(folded)
+                if node is None:
+                    break
+            if node is None:
+                break
+            if self._END in node:
+                end = i + 1
+        
+        if not end:
+            return False, content
+        return True, content[end:].strip()
+
+    def has_prefix(self, content: str) -> bool:
+        """快速判断消息(忽略开头的空白)是否以某个命令开头，不生成新字符串"""
+        node = self._root
+        started = False
+        for ch in content:
+            if not started:
+                if ch.isspace():
+                    continue
+                started = True
+            for folded in ch.casefold():
+                node = node.get(folded)
+                if node is None:
+                    return False
+            if self._END in node:
+                return True
+        return False
+
+
+class StreamReplyChunker:
+    """将流式文本片段合并为句子/段落大小的块，用于分段发送到微信
+    
+    只有累积文本达到最小字数、且距上次发送超过最短间隔时，才会在最后一个句末标点处切分。
+    """
+
+    SENTENCE_ENDINGS = ("\n", "。", "！", "？", "；", "!", "?", ";")
+    MAX_CHUNK_SIZE = 2000  # 找不到句末标点时强制切分的长度
+
+    def __init__(self, min_chunk_size: int = 50, flush_interval: float = 1.5):
+        self.min_chunk_size = min_chunk_size
+        self.flush_interval = flush_interval
+        self._buffer = ""
+        self._last_flush = 0.0
+
+    def push(self, fragment: str) -> str:
+        """追加文本片段
+        
+        Args:
+            fragment: 新的文本片段
+            
+        Returns:
+            str: 可以发送的文本块，暂不需要发送时返回空字符串
+        """
+        self._buffer += fragment
+        if len(self._buffer) < self.min_chunk_size:
+            return ""
+        now = time.monotonic()
+        if now - self._last_flush < self.flush_interval:
+            return ""
+        
+        cut = max(self._buffer.rfind(ending) for ending in self.SENTENCE_ENDINGS) + 1
+        if cut < self.min_chunk_size:
+            if len(self._buffer) < self.MAX_CHUNK_SIZE:
+                return ""
+            cut = self.MAX_CHUNK_SIZE
+        
+        chunk, self._buffer = self._buffer[:cut], self._buffer[cut:]
+        self._last_flush = now
+        return chunk.strip()
+
+    def flush(self) -> str:
+        """取出剩余的全部文本"""
+        chunk, self._buffer = self._buffer, ""
+        return chunk.strip()
+
+
+class DoubaoStreamDecoder:
+    """豆包对话流(SSE)增量解码器
+    
+    以字节块为单位喂入数据，未完整的行会保留在缓冲区中，因此事件被拆分到多个数据块时也能正确解析。
+    事件按 event_type / content_type 查表分发，解析结果累积在实例属性上。
+    """
+
+    def __init__(self):
+        self._buffer = bytearray()
+        self._seen_urls = set()
+        self.text_parts = []  # 流式文本片段
+        self.tts_text = ""  # TTS完整文本，没有文本片段时作为回复
+        self.image_urls = []  # 按出现顺序去重后的图片URL
+        self.image_generating = False  # 是否检测到图片生成中
+        self.completed = False  # 是否收到[DONE]标记
+        self.message_id = None  # 回复消息ID
+        self.conversation_id = None  # 新创建的会话ID
+        self.section_id = None  # 新创建的会话段ID
+        self.pending_images = 0  # 尚未生成完成的图片数
+        self.event_count = 0
+
+    @property
+    def text(self) -> str:
+        """当前累积的回复文本"""
+        if self.text_parts:
+            return "".join(self.text_parts)
+        return self.tts_text
+
+    def feed(self, chunk: bytes) -> list[str]:
+        """喂入一个数据块
+        
+        Args:
+            chunk: 从响应流读取的原始字节
+            
+        Returns:
+            list[str]: 本数据块中新解析出的文本片段
+        """
+        if self.completed:
+            return []
+        start = len(self.text_parts)
+        newline = chunk.rfind(b"\n")
+        if newline < 0:
+            self._buffer += chunk
+            return []
+        
+        # 只有新数据块中出现换行时才会产生完整的行
+        self._buffer += chunk[:newline]
+        lines = bytes(self._buffer).split(b"\n")
+        self._buffer = bytearray(chunk[newline + 1:])
+        for line in lines:
+            self._process_line(line)
+            if self.completed:
+                self._buffer.clear()
+                break
+        return self.text_parts[start:]
+
+    def finish(self) -> list[str]:
+        """处理缓冲区中没有以换行结尾的最后一行
+        
+        Returns:
+            list[str]: 新解析出的文本片段
+        """
+        start = len(self.text_parts)
+        if self._buffer and not self.completed:
+            line = bytes(self._buffer)
+            self._buffer.clear()
+            self._process_line(line)
+        return self.text_parts[start:]
+
+    def handle_message(self, message: dict):
+        """按content_type分发单条消息内容，流式事件与轮询结果共用
+        
+        Args:
+            message: 包含content和content_type的消息字典
+        """
+        handler = self.CONTENT_HANDLERS.get(message.get("content_type"))
+        content = message.get("content")
+        if handler is None or not content:
+            return
+        try:
+            handler(self, _json_loads(content))
+        except Exception as e:
+            logger.error(f"解析消息内容错误(content_type={message.get('content_type')}): {e}")
+
+    def _process_line(self, line: bytes):
+        if not line.startswith(b"data:"):
+            return
+        data = line[5:].strip()
+        if not data:
+            return
+        if data == b"[DONE]":
+            self.completed = True
+            return
+        
+        self.event_count += 1
+        try:
+            # 外层JSON中的event_data本身也是JSON字符串
+            event = _json_loads(data)
+            event_data = event.get("event_data")
+            if not event_data:
+                return
+            event_data = _json_loads(event_data)
+            if not isinstance(event_data, dict):
+                return
+        except Exception as e:
+            if event_log_sampler.sample():
+                logger.error("解析JSON错误: {}", e)
+            return
+        
+        # 检查图片生成状态
+        if event_data.get("status") == "processing" and not self.image_generating:
+            self.image_generating = True
+            if event_log_sampler.sample():
+                logger.debug("检测到图片生成中...")
+        
+        handler = self.EVENT_HANDLERS.get(event.get("event_type"))
+        if handler is not None:
+            handler(self, event_data)
+        
+        # TTS内容是完整文本，只保留第一份
+        tts_content = event_data.get("tts_content")
+        if tts_content and not self.tts_text and tts_content.strip():
+            self.tts_text = tts_content
+
+    def _handle_conversation_event(self, event_data: dict):
+        if event_data.get("conversation_id"):
+            self.conversation_id = event_data["conversation_id"]
+        if event_data.get("section_id"):
+            self.section_id = event_data["section_id"]
+
+    def _handle_message_event(self, event_data: dict):
+        if event_data.get("message_id"):
+            self.message_id = event_data["message_id"]
+        if self.conversation_id is None:
+            self._handle_conversation_event(event_data)
+        message = event_data.get("message")
+        if message:
+            self.handle_message(message)
+
+    def _handle_text_content(self, content_obj: dict):
+        text = content_obj.get("text")
+        if text and text.strip():
+            self.text_parts.append(text)
+
+    def _handle_image_content(self, content_obj: dict):
+        found = False
+        
+        # 常规图片格式
+        data = content_obj.get("data")
+        if isinstance(data, list):
+            for img_data in data:
+                url = self._url_of(img_data, "image_ori")
+                if url:
+                    self._add_image(url)
+                    found = True
+        
+        # 备用格式
+        if not found:
+            url = self._url_of(content_obj, "image")
+            if url:
+                self._add_image(url)
+                found = True
+        
+        # 直接URL格式
+        if not found and content_obj.get("url"):
+            self._add_image(content_obj["url"])
+            found = True
+        
+        if not found and event_log_sampler.sample():
+            logger.opt(lazy=True).debug("未提取到图片: {}", lambda: str(content_obj)[:200])
+
+    def _handle_creation_content(self, content_obj: dict):
+        creations = content_obj.get("creations")
+        if not isinstance(creations, list):
+            return
+        for item in creations:
+            if item.get("type") != 1:
+                continue
+            img_data = item.get("image")
+            if not isinstance(img_data, dict):
+                continue
+            # 状态2表示图片已完成
+            if img_data.get("status") != 2:
+                self.pending_images += 1
+                continue
+            # 默认使用原图URL，依次回退到无水印原图和缩略图
+            url = (self._url_of(img_data, "image_ori")
+                   or self._url_of(img_data, "image_raw")
+                   or self._url_of(img_data, "image_thumb"))
+            if url:
+                self._add_image(url)
+
+    def _add_image(self, url: str):
+        if url not in self._seen_urls:
+            self._seen_urls.add(url)
+            self.image_urls.append(url)
+            if event_log_sampler.sample():
+                logger.debug("发现图片URL: {}", url)
+
+    @staticmethod
+    def _url_of(obj: dict, key: str) -> str:
+        value = obj.get(key)
+        if isinstance(value, dict):
+            return value.get("url") or ""
+        return ""
+
+    # event_type -> 事件处理函数
+    EVENT_HANDLERS = {
+        2001: _handle_message_event,  # 消息事件
+        2002: _handle_conversation_event,  # 会话创建事件
+    }
+
+    # content_type -> 内容处理函数
+    CONTENT_HANDLERS = {
+        2001: _handle_text_content,  # 文本内容
+        10000: _handle_text_content,  # 文本内容
+        2010: _handle_image_content,  # 图片内容
+        2074: _handle_creation_content,  # 图片集信息
+    }
+
+
+def verify_image_file(image_path: str):
+    """校验图片文件完整性，无效时抛出异常"""
+    with Image.open(image_path) as img:
+        img.verify()
+
+
+@functools.lru_cache(maxsize=8)
+def _load_badge_font(font_size: int):
+    """加载序号字体，按字号缓存，避免每张图片都重新查找字体文件"""
+    try:
+        # 尝试加载微软雅黑
+        return ImageFont.truetype("msyh.ttc", font_size)
+    except Exception:
+        try:
+            # 尝试加载Arial
+            return ImageFont.truetype("arial.ttf", font_size)
+        except Exception:
+            # 使用默认字体
+            return ImageFont.load_default()
+
+
+@functools.lru_cache(maxsize=64)
+def _render_number_badge(number: int, font_size: int):
+    """预渲染序号角标(黑色边框、白色背景、加粗黑字)，按(序号, 字号)缓存
+    
+    Returns:
+        (角标图片, 文字宽度)
+    """
+    font = _load_badge_font(font_size)
+    number_text = str(number)
+    
+    # 计算文本尺寸
+    measure = ImageDraw.Draw(Image.new("RGB", (1, 1)))
+    try:
+        # PIL 9.0.0及以上版本
+        left, top, right, bottom = measure.textbbox((0, 0), number_text, font=font, stroke_width=1)
+    except Exception:
+        # 旧版本PIL
+        width, height = measure.textsize(number_text, font=font)
+        left, top, right, bottom = 0, 0, width, height
+    text_width = right - left
+    text_height = bottom - top
+    
+    # 极小的背景内边距，让数字几乎充满整个背景框；3px黑色边框提高视觉对比度
+    bg_padding = max(2, int(font_size / 20))
+    border_width = 3
+    inset = bg_padding + border_width
+    badge = Image.new("RGB", (text_width + inset * 2, text_height + inset * 2), (0, 0, 0))
+    draw = ImageDraw.Draw(badge)
+    draw.rectangle([border_width, border_width, badge.width - border_width - 1, badge.height - border_width - 1], fill=(255, 255, 255))
+    
+    # 使用描边实现加粗效果，只需绘制一次
+    try:
+        draw.text((inset - left, inset - top), number_text, fill=(0, 0, 0), font=font, stroke_width=1, stroke_fill=(0, 0, 0))
+    except TypeError:
+        draw.text((inset - left, inset - top), number_text, fill=(0, 0, 0), font=font)
+    return badge, text_width
+
+
+def _load_grid_tile(img_path: str, size: tuple[int, int]):
+    """按目标尺寸加载单张图片
+    
+    JPEG使用draft模式直接以缩小的分辨率解码；其他格式(豆包生成的图片是PNG)只能完整解码，
+    原图是目标尺寸两倍以上时先用reduce按整数倍快速缩小，再做高质量缩放。
+    """
+    with Image.open(img_path) as img:
+        img.draft("RGB", size)
+        # reduce不支持调色板(P)、二值(1)和16位灰度等模式，先统一转为RGB
+        if img.mode != "RGB":
+            img = img.convert("RGB")
+        factor = min(img.width // size[0], img.height // size[1])
+        if factor >= 2:
+            img = img.reduce(factor)
+        return img.resize(size, Image.LANCZOS)
+
+
+def grid_size_for(n_images: int) -> tuple[int, int]:
+    """根据图片数量计算网格的(列数, 行数)"""
+    if n_images <= 2:
+        return (n_images, 1)  # 1行，n列
+    elif n_images <= 4:
+        return (2, 2)  # 2行2列
+    elif n_images <= 6:
+        return (3, 2)  # 2行3列
+    elif n_images <= 9:
+        return (3, 3)  # 3行3列
+    return (4, (n_images + 3) // 4)  # 4列，行数根据图片数量计算
+
+
+class MessageEnvelope:
+    """从原始消息字典中解析出的消息信息
+    
+    每条消息只解析一次，之后的处理都使用解析结果，不再反复查询原始字典中的各种字段格式。
+    """
+
+    __slots__ = ("content", "text", "sender_id", "sender_name", "room_id", "is_group", "is_at", "quote", "received_at")
+
+    # 兼容不同格式的消息结构，按顺序查找
+    CONTENT_FIELDS = ("Content", "content", "msg", "text", "message", "Message")
+    SENDER_FIELDS = ("SenderWxid", "FromWxid", "wxid")
+
+    def __init__(self, content: str, text: str, sender_id: str, sender_name: str, room_id: str,
+                 is_at: bool, quote: dict = None, received_at: float = None):
+        self.content = content  # 原始消息内容(去除首尾空白)
+        self.text = text  # 去除@机器人前缀后的内容
+        self.sender_id = sender_id
+        self.sender_name = sender_name
+        self.room_id = room_id  # 群聊ID，私聊为空
+        self.is_group = bool(room_id)
+        self.is_at = is_at  # 群聊中是否@了机器人
+        self.quote = quote  # 被引用的消息，没有时为None
+        self.received_at = received_at or time.monotonic()
+
+    @property
+    def target_id(self) -> str:
+        """回复的发送目标"""
+        return self.room_id or self.sender_id
+
+    @classmethod
+    def parse(cls, message: dict, bot_wxid: str = "", received_at: float = None) -> "MessageEnvelope":
+        """解析原始消息字典
+        
+        Args:
+            message: 框架传入的消息字典
+            bot_wxid: 机器人wxid，用于判断是否@了机器人
+            received_at: 收到消息的时间(time.monotonic())
+        """
+        content = ""
+        for field in cls.CONTENT_FIELDS:
+            value = message.get(field)
+            if value:
+                content = str(value).strip()
+                if content:
+                    break
+        
+        sender_id = ""
+        for field in cls.SENDER_FIELDS:
+            if message.get(field):
+                sender_id = message[field]
+                break
+        
+        # 群聊消息的FromWxid是群ID
+        room_id = ""
+        if message.get("IsGroup") and message.get("FromWxid"):
+            room_id = message["FromWxid"]
+        elif message.get("room_wxid"):
+            room_id = message["room_wxid"]
+        
+        # 获取发送者昵称，没有时从推送内容("昵称 : 内容")中提取
+        sender_name = message.get("FromName") or message.get("sender_name") or ""
+        if not sender_name:
+            push_content = message.get("PushContent") or ""
+            if " : " in push_content:
+                sender_name = push_content.split(" : ")[0]
+        
+        # 检查不同格式的@标记
+        is_at = False
+        text = content
+        if room_id:
+            is_at = bool(
+                message.get("is_at")
+                or message.get("IsAt")
+                or (bot_wxid and bot_wxid in (message.get("AtWxidList") or ()))
+                or (bot_wxid and bot_wxid in (message.get("Ats") or ()))
+                or (bot_wxid and f"@{bot_wxid}" in content)
+            )
+            # 如果是@消息，移除@前缀
+            bot_name_mention = f"@{message.get('bot_name', '')}"
+            if is_at and content.startswith(bot_name_mention):
+                text = content.replace(bot_name_mention, "").strip()
+        
+        return cls(content, text, sender_id or "unknown_user", sender_name, room_id, is_at,
+                   message.get("Quote") or None, received_at)
+
+
+class ReplyContext:
+    """一次豆包回复的处理状态，在回复流水线的各阶段之间传递"""
+
+    def __init__(self, bot, message: MessageEnvelope, prompt: str, is_at: bool, source: str = "text"):
+        self.bot = bot
+        self.message = message
+        self.prompt = prompt  # 发送给豆包的提示词
+        self.from_id = message.sender_id
+        self.from_name = message.sender_name
+        self.room_id = message.room_id
+        self.is_group = message.is_group
+        self.is_at = is_at  # 群聊中是否@发送者回复
+        self.target_id = message.target_id
+        self.source = source  # 消息来源: text 或 quote
+        self.use_response_cache = False  # 是否可以读写回复缓存(没有上下文的请求)
+        self.from_cache = False  # 回复是否来自缓存
+        self.response_text = ""
+        self.image_urls = []
+        self.text_delivered = False  # 回复文本是否已发送(流式模式下边生成边发送)
+        self.saved_images = []  # 下载成功的图片信息
+        self.grid_path = None  # 多张图片的网格图路径
+        self.timings = {}  # 阶段名 -> 累计耗时(秒)
+
+
+def render_image_grid(image_files, output_path, grid_size=(2, 2), gap=4, background_color=(255, 255, 255), img_size=(800, 800), quality=75):
+    """
+    创建高质量图片网格，模拟豆包网站的图片展示布局
+    
+    定义为模块级函数，以便在线程池或进程池中执行
+
+    参数:
+        image_files: 图片文件路径列表
+        output_path: 输出的网格图片路径
+        grid_size: 网格大小(列数, 行数)
+        gap: 图片间距（像素）
+        background_color: 背景颜色
+        img_size: 单个图片的尺寸，默认(800, 800)以获得更高清的效果
+        quality: 输出JPEG质量(1-95)
+
+    返回:
+        生成的网格图片路径
+    """
+    if not image_files:
+        return None
+
+    # 计算网格尺寸
+    n_images = len(image_files)
+    cols, rows = grid_size
+
+    # 确保网格能容纳所有图片
+    while cols * rows < n_images:
+        if cols <= rows:
+            cols += 1
+        else:
+            rows += 1
+
+    img_width, img_height = img_size
+
+    # 设置序号字体大小，确保在合理范围内(最小100px，最大350px)
+    font_size = max(100, min(int(img_width / 5), 350))
+    padding = max(10, int(font_size / 8))
+
+    # 计算网格图片大小并创建白色背景画布
+    grid_width = cols * img_width + (cols - 1) * gap
+    grid_height = rows * img_height + (rows - 1) * gap
+    grid_img = None
+
+    # 逐张加载并放置图片，不同时在内存中保留所有原图。
+    # 按图片在列表中的位置放置和编号，某张图片加载失败时留空，序号仍与「查看图片 序号」一致
+    for index, img_path in enumerate(image_files):
+        if index >= cols * rows:
+            break  # 超出网格容量
+        number = index + 1
+        try:
+            tile = _load_grid_tile(img_path, (img_width, img_height))
+        except Exception as e:
+            logger.error(f"无法加载图片 {img_path}: {str(e)}")
+            continue
+
+        if grid_img is None:
+            grid_img = Image.new('RGB', (grid_width, grid_height), background_color)
+
+        x = (index % cols) * (img_width + gap)
+        y = (index // cols) * (img_height + gap)
+        grid_img.paste(tile, (x, y))
+
+        # 在右上角粘贴预渲染的序号角标
+        try:
+            badge, text_width = _render_number_badge(number, font_size)
+            inset = (badge.width - text_width) // 2
+            grid_img.paste(badge, (x + img_width - text_width - padding - inset, y + padding - inset))
+        except Exception as e:
+            logger.error(f"绘制序号时出错: {e}")
+            # 备用方案
+            try:
+                ImageDraw.Draw(grid_img).text((x + img_width - 60, y + 20), str(number), fill=(0, 0, 0))
+            except Exception:
+                logger.error("备用序号绘制也失败")
+
+    if grid_img is None:
+        return None
+
+    # 保存为JPEG。optimize/progressive只能再减小1%~3%的体积，编码耗时却增加一到四倍，因此不使用
+    grid_img.save(output_path, "JPEG", quality=quality)
+    return output_path
+
+
 class Doubao(PluginBase):
     """豆包AI助手插件"""
     name = "Doubao"
@@ -41,11 +1956,79 @@ class Doubao(PluginBase):
         # 添加wxid初始化标志
         self.initialized_wxid = False  # 初始设为False以触发初始化
         
-        # 添加图片缓存
-        self.image_cache = {}  # 用于存储用户会话的图片信息
+        # 每个(群, 用户)最近一次生成的图片，重启后从文件恢复
+        self.image_selections = ImageSelectionStore(
+            self.plugin_dir / "image_selections.json",
+            ttl=self.image_selection_ttl,
+            max_users=self.image_selection_max_users
+        )
+        
+        # 按内容寻址的图片文件缓存，已下载过的图片URL不再重复下载
+        self.image_file_cache = ImageFileCache(
+            self.cache_dir, "doubao_img_",
+            max_files=self.image_cache_max_files,
+            max_bytes=int(self.image_cache_max_mb * 1024 * 1024)
+        )
+        self.grid_file_cache = ImageFileCache(self.cache_dir, "doubao_grid_", max_files=10)  # 网格图片保留最新的10张
+        
+        # 共享HTTP会话(连接池)，在首次请求时创建，插件卸载时关闭
+        self._http_session = None
+        self._http_stats = {
+            "sessions_created": 0,
+            "requests": 0,
+            "request_errors": 0,
+            "connections_created": 0,
+            "connections_reused": 0
+        }
+        
+        # 图片并发下载信号量，在首次下载时创建
+        self._download_semaphore = None
+        
+        # 图片渲染工作池，在首次使用时创建
+        self._render_executor = None
+        self._render_pending = 0
+        
+        # 相同提示词的回复缓存
+        self.response_cache = None
+        if self.enable_response_cache:
+            self.response_cache = ResponseCache(
+                ttl=self.response_cache_ttl,
+                max_entries=self.response_cache_max_entries,
+                max_bytes=self.response_cache_max_bytes
+            )
+        
+        # 对话接口和各图片CDN域名分别熔断
+        self.completion_breaker = self.create_circuit_breaker("completion")
+        self._cdn_breakers = {}  # 域名 -> CircuitBreaker
+        
+        # 快速过滤掉的无关消息数
+        self.fast_rejected = 0
+        
+        # 回复流水线的阶段耗时回调，参数为(阶段名, 耗时秒数, ReplyContext)
+        self.stage_hooks = []
+        
+        # 各环节的耗时和计数指标，可通过HTTP接口或定期写入文件导出
+        self.metrics = MetricsRegistry()
+        self._register_metrics()
+        self.add_stage_hook(self._observe_stage)
+        self._metrics_runner = None
+        
+        # 调用豆包前的全局并发控制和公平排队
+        self.request_scheduler = FairRequestScheduler(
+            max_concurrent=self.max_concurrent_requests,
+            max_queue_depth=self.max_queue_depth,
+            max_queued_per_user=self.max_queued_per_user
+        )
+        
+        # 相同提示词的并发对话和相同图片组的并发下载只执行一次
+        self._completion_flights = SingleFlight()
+        self._download_flights = SingleFlight()
         
-        # 添加会话状态管理
-        self.user_sessions = {}  # 用于存储用户会话状态
+        # 每个会话共用一个图片结果轮询器
+        self._image_pollers = {}
+        
+        # 添加会话状态管理，会话超过session_timeout无消息后过期
+        self.user_sessions = TTLCache(self.session_timeout, self.max_sessions)  # 用于存储用户会话状态
         self.system_prompt = ""
         # 添加前置提示词
 #         self.system_prompt = """我是豆包助手，性格活泼可爱，语言风趣幽默，18岁的二次元阳光少年。主业是程序员，精通各种编程；副业是技术博主，知识储备丰富。我可以帮你解答任何问题，也可以帮你使用群工具：
@@ -65,8 +2048,26 @@ class Doubao(PluginBase):
 
 # 下面是用户的问题，请用上面的人设回答："""
 
+        # 每日对话次数保存在内存中，批量写入文件
+        self.quota_store = DailyQuotaStore(self.plugin_dir / "user_limits.json", self.quota_flush_every)
+        self._background_tasks = set()
+        
+        # 聊天记录由后台任务批量写入JSONL文件(按天轮转)或带索引的SQLite数据库
+        if self.history_backend == "sqlite":
+            history_store = SqliteHistoryStore(self.plugin_dir / "chat_history.db")
+        else:
+            history_store = JsonlHistoryStore(self.plugin_dir / "chat_history.jsonl", self.history_compress)
+        self.history_writer = ChatHistoryWriter(
+            history_store,
+            batch_size=self.history_batch_size,
+            flush_interval=self.history_flush_interval
+        )
+
         # 在初始化时调度异步清理缓存任务
-        asyncio.create_task(self.clean_image_cache(25))
+        self.run_background(self.clean_image_cache())
+        
+        if self.metrics_port:
+            self.run_background(self.start_metrics_server())
 
     def load_config(self):
         """加载配置"""
@@ -78,14 +2079,40 @@ class Doubao(PluginBase):
                 self.conversation_id = config["conversation_id"]
                 self.section_id = config.get("section_id", f"{self.conversation_id}138")
                 self.cookie = config.get("cookie", "")
+                
+                # 加载账号池，未配置accounts时使用上面的单个账号
+                accounts = [
+                    DoubaoAccount(
+                        item.get("name", f"账号{i+1}"),
+                        item["conversation_id"],
+                        item.get("section_id", f"{item['conversation_id']}138"),
+                        item.get("cookie", "")
+                    )
+                    for i, item in enumerate(config.get("accounts", []))
+                ]
+                if not accounts:
+                    accounts = [DoubaoAccount("默认账号", self.conversation_id, self.section_id, self.cookie)]
+                self.account_pool = DoubaoAccountPool(
+                    accounts,
+                    cooldown=config.get("account_cooldown", 300),  # 账号出错后暂停使用的时间(秒)
+                    error_threshold=config.get("account_error_threshold", 0.5)  # 错误率超过该值时暂停使用
+                )
                 self.admin_list = config.get("admin_list", [])
                 self.private_chat = config.get("private_chat", True)  # 是否允许私聊
                 self.group_chat = config.get("group_chat", True)  # 是否允许群聊
                 self.admin_only = config.get("admin_only", True)  # 是否仅管理员可用
                 self.bot_wxid = config.get("bot_wxid", "")  # 机器人自己的wxid
                 self.daily_limit = config.get("daily_limit", 20)  # 每人每日对话限制
+                
+                # 加载会话模式配置
+                self.enable_session = config.get("enable_session", False)  # 是否启用用户会话
+                self.session_timeout = config.get("session_timeout", 30)  # 会话超时时间(秒)
+                self.session_scope = config.get("session_scope", "user")  # user: 每个用户一个会话; group: 群内共用一个会话
+                self.max_sessions = config.get("max_sessions", 1000)  # 内存中最多保留的会话数
+                self.quota_flush_every = config.get("quota_flush_every", 20)  # 对话次数累计修改多少次后写入文件
                 # 加载命令列表
                 self.commands = config.get("commands", ["#豆包", "#db", "#doubao", "#豆"])
+                self.command_matcher = CommandMatcher(self.commands)
                 
                 # 加载引用功能相关配置
                 self.enable_quote = config.get("enable_quote", True)  # 是否启用引用功能
@@ -93,18 +2120,339 @@ class Doubao(PluginBase):
                 self.group_quote = config.get("group_quote", True)  # 是否允许群聊引用
                 self.quote_require_at = config.get("quote_require_at", True)  # 群聊引用是否需要@
                 
+                # 加载网络连接池配置
+                self.http_pool_limit = config.get("http_pool_limit", 100)  # 连接池最大连接数
+                self.http_pool_limit_per_host = config.get("http_pool_limit_per_host", 20)  # 每个主机最大连接数
+                self.http_keepalive_timeout = config.get("http_keepalive_timeout", 60)  # 空闲连接保持时间(秒)
+                self.http_dns_cache_ttl = config.get("http_dns_cache_ttl", 300)  # DNS缓存时间(秒)
+                
+                # 聊天记录写入配置
+                self.history_backend = config.get("history_backend", "jsonl")  # jsonl 或 sqlite(带索引，支持查询)
+                self.history_batch_size = config.get("history_batch_size", 50)  # 每批写入的记录数
+                self.history_flush_interval = config.get("history_flush_interval", 5)  # 最长写入间隔(秒)
+                self.history_compress = config.get("history_compress", True)  # 按天轮转后是否gzip压缩
+                
+                # 并发控制配置
+                self.max_concurrent_requests = config.get("max_concurrent_requests", 4)  # 同时调用豆包的最大请求数
+                self.max_queue_depth = config.get("max_queue_depth", 20)  # 最多排队的请求数
+                self.max_queued_per_user = config.get("max_queued_per_user", 2)  # 每个用户最多排队的请求数
+                self.busy_message = config.get("busy_message", "豆包正忙，请稍后再试~")  # 排队过多时的回复
+                
+                # 是否合并相同提示词的并发请求
+                self.enable_request_coalescing = config.get("enable_request_coalescing", True)
+                
+                # 回复缓存配置
+                self.enable_response_cache = config.get("enable_response_cache", False)  # 是否缓存相同提示词的回复
+                self.response_cache_ttl = config.get("response_cache_ttl", 300)  # 缓存有效期(秒)
+                self.response_cache_max_entries = config.get("response_cache_max_entries", 500)  # 最多缓存条数
+                self.response_cache_max_bytes = config.get("response_cache_max_bytes", 2 * 1024 * 1024)  # 最多占用字节数
+                self.response_cache_exclude = [
+                    keyword.casefold()
+                    for keyword in config.get("response_cache_exclude", ["画", "图片", "照片", "生成", "几点", "现在", "最新", "新闻"])
+                ]  # 包含这些关键词的提示词不缓存
+                
+                # 流式回复配置
+                self.stream_reply = config.get("stream_reply", False)  # 是否边生成边发送回复
+                self.stream_min_chunk_size = config.get("stream_min_chunk_size", 50)  # 每段最少字数
+                self.stream_flush_interval = config.get("stream_flush_interval", 1.5)  # 两段之间最短间隔(秒)
+                
+                # 熔断配置，对话接口和图片CDN域名分别统计
+                self.circuit_failure_rate = config.get("circuit_failure_rate", 0.5)  # 触发熔断的失败率
+                self.circuit_min_requests = config.get("circuit_min_requests", 5)  # 统计失败率的最少请求数
+                self.circuit_window = config.get("circuit_window", 20)  # 统计最近多少次请求
+                self.circuit_reset_timeout = config.get("circuit_reset_timeout", 30)  # 熔断后多久重新探测(秒)
+                self.circuit_half_open_probes = config.get("circuit_half_open_probes", 1)  # 半开状态放行的探测请求数
+                self.circuit_open_message = config.get("circuit_open_message", "豆包服务暂时不可用，请稍后再试~")  # 熔断期间的回复
+                
+                # 单条消息从排队到发送图片的最长处理时间(秒)，超时后只发送已得到的文本，0为不限时
+                self.request_deadline = config.get("request_deadline", 120)
+                
+                # 图片生成等待配置
+                self.image_poll_initial_delay = config.get("image_poll_initial_delay", 1.0)  # 首次轮询间隔(秒)
+                self.image_poll_max_delay = config.get("image_poll_max_delay", 5.0)  # 最大轮询间隔(秒)
+                self.image_poll_timeout = config.get("image_poll_timeout", 60)  # 最长等待时间(秒)
+                
+                # 图片下载配置
+                self.download_concurrency = config.get("download_concurrency", 4)  # 同时下载的图片数量
+                self.image_cache_max_files = config.get("image_cache_max_files", 25)  # 最多缓存的图片数
+                self.image_cache_max_mb = config.get("image_cache_max_mb", 200)  # 图片缓存最大占用空间(MB)
+                self.image_selection_ttl = config.get("image_selection_ttl", 86400)  # 「查看图片」的有效期(秒)
+                self.image_selection_max_users = config.get("image_selection_max_users", 1000)  # 最多记录多少用户的图片
+                
+                # 图片渲染工作池配置
+                self.render_executor_type = config.get("render_executor", "thread")  # thread 或 process
+                self.render_workers = config.get("render_workers", 2)  # 工作线程/进程数
+                self.render_queue_size = config.get("render_queue_size", 4)  # 最多排队的网格渲染任务数
+                self.grid_jpeg_quality = config.get("grid_jpeg_quality", 75)  # 网格图片JPEG质量
+                
+                # 对话流录制目录(相对插件目录)，留空则不录制
+                self.stream_record_dir = config.get("stream_record_dir", "")
+                
+                # 指标导出配置
+                self.metrics_host = config.get("metrics_host", "127.0.0.1")  # 指标HTTP接口监听地址
+                self.metrics_port = config.get("metrics_port", 0)  # 指标HTTP接口端口，0为不启用
+                self.metrics_file = config.get("metrics_file", "")  # 定期写入指标的文件(相对插件目录)，留空则不写入
+                
+                # 日志配置
+                self.log_message_dump = config.get("log_message_dump", False)  # 是否在DEBUG日志中记录完整的消息内容
+                self.log_sample_rate = config.get("log_sample_rate", 1.0)  # 流事件日志的采样比例(0~1)
+                event_log_sampler.rate = self.log_sample_rate
+                
                 logger.info(f"豆包命令列表: {self.commands}")
                 logger.info(f"豆包引用功能: {'启用' if self.enable_quote else '禁用'}")
         except Exception as e:
             logger.error(f"加载配置文件失败: {e}")
 
-    def is_admin(self, wxid: str) -> bool:
-        """检查是否为管理员"""
-        return wxid in self.admin_list
+    async def on_disable(self):
+        """插件禁用/卸载时保存对话次数、图片记录和聊天记录，并关闭共享连接池和渲染工作池"""
+        await super().on_disable()
+        await self.quota_store.flush()
+        await self.image_selections.flush()
+        await self.history_writer.close()
+        await self.close_http_session()
+        if self._metrics_runner is not None:
+            await self._metrics_runner.cleanup()
+            self._metrics_runner = None
+        if self._render_executor is not None:
+            self._render_executor.shutdown(wait=False, cancel_futures=True)
+            self._render_executor = None
+
+    async def get_http_session(self) -> aiohttp.ClientSession:
+        """获取插件共享的HTTP会话
+        
+        所有与豆包相关的请求(对话、轮询、图片下载)共用同一个连接池，
+        避免每次请求都重新建立TCP+TLS连接。
+        
+        Returns:
+            aiohttp.ClientSession: 共享会话
+        """
+        if self._http_session is None or self._http_session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.http_pool_limit,
+                limit_per_host=self.http_pool_limit_per_host,
+                keepalive_timeout=self.http_keepalive_timeout,
+                use_dns_cache=True,
+                ttl_dns_cache=self.http_dns_cache_ttl,
+                enable_cleanup_closed=True
+            )
+            
+            # 通过trace回调统计连接的新建与复用情况
+            trace_config = aiohttp.TraceConfig()
+            trace_config.on_request_start.append(self._on_http_request_start)
+            trace_config.on_request_exception.append(self._on_http_request_exception)
+            trace_config.on_connection_create_end.append(self._on_http_connection_create)
+            trace_config.on_connection_reuseconn.append(self._on_http_connection_reuse)
+            
+            self._http_session = aiohttp.ClientSession(connector=connector, trace_configs=[trace_config])
+            self._http_stats["sessions_created"] += 1
+            logger.info(f"已创建豆包共享连接池: 总连接数上限{self.http_pool_limit}, 单主机上限{self.http_pool_limit_per_host}")
+        return self._http_session
+
+    async def close_http_session(self):
+        """关闭共享HTTP会话"""
+        session = self._http_session
+        self._http_session = None
+        if session is not None and not session.closed:
+            try:
+                await session.close()
+                logger.info("豆包共享连接池已关闭")
+            except Exception as e:
+                logger.error(f"关闭连接池失败: {e}")
+
+    def get_http_pool_stats(self) -> dict:
+        """获取连接池统计信息
+        
+        Returns:
+            dict: 连接池配置及请求/连接计数
+        """
+        stats = dict(self._http_stats)
+        stats["active"] = self._http_session is not None and not self._http_session.closed
+        stats["limit"] = self.http_pool_limit
+        stats["limit_per_host"] = self.http_pool_limit_per_host
+        return stats
+
+    async def _on_http_request_start(self, session, trace_config_ctx, params):
+        self._http_stats["requests"] += 1
+
+    async def _on_http_request_exception(self, session, trace_config_ctx, params):
+        self._http_stats["request_errors"] += 1
+
+    async def _on_http_connection_create(self, session, trace_config_ctx, params):
+        self._http_stats["connections_created"] += 1
+
+    async def _on_http_connection_reuse(self, session, trace_config_ctx, params):
+        self._http_stats["connections_reused"] += 1
+
+    def create_circuit_breaker(self, name: str) -> CircuitBreaker:
+        """按配置创建熔断器"""
+        return CircuitBreaker(
+            name,
+            failure_rate=self.circuit_failure_rate,
+            min_requests=self.circuit_min_requests,
+            window=self.circuit_window,
+            reset_timeout=self.circuit_reset_timeout,
+            half_open_probes=self.circuit_half_open_probes
+        )
+
+    def get_cdn_breaker(self, url: str) -> CircuitBreaker:
+        """获取图片URL所在CDN域名的熔断器"""
+        host = urlsplit(url).hostname or ""
+        breaker = self._cdn_breakers.get(host)
+        if breaker is None:
+            breaker = self._cdn_breakers[host] = self.create_circuit_breaker(f"cdn:{host}")
+        return breaker
+
+    def get_circuit_stats(self) -> dict:
+        """对话接口和各CDN域名的熔断状态，用于监控"""
+        return {
+            "completion": self.completion_breaker.stats(),
+            "cdn": {host: breaker.stats() for host, breaker in self._cdn_breakers.items()}
+        }
+
+    def _register_metrics(self):
+        """声明插件的所有指标"""
+        metrics = self.metrics
+        metrics.register("doubao_stage_seconds", "histogram", "回复流水线各阶段的耗时(秒)")
+        metrics.register("doubao_upstream_ttfb_seconds", "histogram", "对话请求从发出到收到响应头的耗时(秒)")
+        metrics.register("doubao_upstream_stream_seconds", "histogram", "对话流式响应从响应头到结束的耗时(秒)")
+        metrics.register("doubao_image_poll_seconds", "histogram", "等待图片生成完成的耗时(秒)")
+        metrics.register("doubao_image_download_seconds", "histogram", "单张图片下载的耗时(秒)")
+        metrics.register("doubao_grid_render_seconds", "histogram", "网格图片渲染的耗时(秒)")
+        metrics.register("doubao_send_seconds", "histogram", "发送微信消息的耗时(秒)")
+        metrics.register("doubao_completions_total", "counter", "对话请求数，按结果区分")
+        metrics.register("doubao_image_downloads_total", "counter", "图片获取次数，按结果区分")
+        metrics.register("doubao_rejections_total", "counter", "未调用豆包就拒绝的请求数，按原因区分")
+        metrics.register("doubao_ignored_messages_total", "counter", "快速过滤掉的无关消息数")
+        metrics.register("doubao_response_cache_requests_total", "counter", "回复缓存查询次数，按是否命中区分")
+        metrics.register("doubao_image_cache_requests_total", "counter", "图片文件缓存查询次数，按是否命中区分")
+        metrics.register("doubao_scheduler_requests", "gauge", "正在执行和排队中的豆包请求数")
+        metrics.register("doubao_circuit_state", "gauge", "熔断器状态: 0正常, 1熔断, 2半开")
+        metrics.register("doubao_http_requests_total", "counter", "共享连接池的请求和连接计数")
+
+    def _observe_stage(self, stage: str, elapsed: float, ctx: ReplyContext):
+        """记录回复流水线的阶段耗时"""
+        self.metrics.observe("doubao_stage_seconds", elapsed, stage=stage, source=ctx.source)
+
+    def collect_metrics(self):
+        """把各组件自带的统计同步到指标中"""
+        metrics = self.metrics
+        metrics.set("doubao_ignored_messages_total", self.fast_rejected)
+        if self.response_cache is not None:
+            metrics.set("doubao_response_cache_requests_total", self.response_cache.hits, result="hit")
+            metrics.set("doubao_response_cache_requests_total", self.response_cache.misses, result="miss")
+        metrics.set("doubao_image_cache_requests_total", self.image_file_cache.hits, result="hit")
+        metrics.set("doubao_image_cache_requests_total", self.image_file_cache.misses, result="miss")
+        metrics.set("doubao_scheduler_requests", self.request_scheduler.running, state="running")
+        metrics.set("doubao_scheduler_requests", self.request_scheduler.queued, state="queued")
+        
+        state_codes = {CircuitBreaker.CLOSED: 0, CircuitBreaker.OPEN: 1, CircuitBreaker.HALF_OPEN: 2}
+        for breaker in [self.completion_breaker, *self._cdn_breakers.values()]:
+            metrics.set("doubao_circuit_state", state_codes[breaker.state], breaker=breaker.name)
+        
+        for event, count in self._http_stats.items():
+            metrics.set("doubao_http_requests_total", count, event=event)
+
+    def render_metrics(self) -> str:
+        """输出Prometheus文本格式的指标"""
+        self.collect_metrics()
+        return self.metrics.render()
+
+    async def start_metrics_server(self):
+        """启动本地指标HTTP接口(GET /metrics)"""
+        try:
+            app = web.Application()
+            app.router.add_get("/metrics", self._handle_metrics_request)
+            runner = web.AppRunner(app, access_log=None)
+            await runner.setup()
+            await web.TCPSite(runner, self.metrics_host, self.metrics_port).start()
+            self._metrics_runner = runner
+            logger.info(f"指标接口已启动: http://{self.metrics_host}:{self.metrics_port}/metrics")
+        except Exception as e:
+            logger.error(f"启动指标接口失败: {e}")
+
+    async def _handle_metrics_request(self, request: web.Request) -> web.Response:
+        return web.Response(text=self.render_metrics(), content_type="text/plain", charset="utf-8")
+
+    @schedule('interval', seconds=60)
+    async def dump_metrics(self, bot: WechatAPIClient):
+        """定期将指标写入metrics_file"""
+        if not self.metrics_file:
+            return
+        try:
+            await asyncio.to_thread(write_file_atomic, self.plugin_dir / self.metrics_file, self.render_metrics())
+        except Exception as e:
+            logger.error(f"写入指标文件失败: {e}")
+
+    def is_admin(self, wxid: str) -> bool:
+        """检查是否为管理员"""
+        return wxid in self.admin_list
+
+    def get_session_key(self, from_id: str, room_id: str) -> str:
+        """获取会话键，群聊中按用户或按群区分会话"""
+        if room_id and self.session_scope == "group":
+            return room_id
+        return f"{room_id}:{from_id}"
+
+    def get_chat_session(self, session_key: str, create: bool = False) -> dict:
+        """获取有效期内的用户会话，并刷新过期时间
+        
+        Args:
+            session_key: 会话键
+            create: 不存在时是否创建新会话
+            
+        Returns:
+            dict: 会话信息(绑定的账号和豆包会话ID)，未启用会话模式或不存在时返回None
+        """
+        if not self.enable_session:
+            return None
+        chat_session = self.user_sessions.get(session_key, touch=True)
+        if chat_session is None and create:
+            chat_session = {"account": None, "conversation_id": None, "section_id": None}
+            self.user_sessions.set(session_key, chat_session)
+            logger.debug(f"开始新会话: {session_key}")
+        return chat_session
+
+    def _response_cache_key(self, prompt: str) -> str:
+        """获取回复缓存键，未启用缓存或提示词包含排除关键词时返回None"""
+        if self.response_cache is None or not prompt:
+            return None
+        key = normalize_prompt(prompt)
+        if any(keyword in key for keyword in self.response_cache_exclude):
+            return None
+        return key
+
+    def get_cached_response(self, prompt: str) -> str:
+        """查询提示词的缓存回复
+        
+        Args:
+            prompt: 去除命令前缀后的提示词
+            
+        Returns:
+            str: 缓存的回复文本，未命中时返回None
+        """
+        key = self._response_cache_key(prompt)
+        if key is None:
+            return None
+        return self.response_cache.get(key)
+
+    def cache_response(self, prompt: str, response_text: str, image_urls: list[str]):
+        """缓存纯文本回复，带图片或失败的回复不缓存
+        
+        Args:
+            prompt: 去除命令前缀后的提示词
+            response_text: 回复文本
+            image_urls: 图片URL列表
+        """
+        key = self._response_cache_key(prompt)
+        if key is None or not response_text or image_urls:
+            return
+        if response_text.startswith(("请求失败", "对话失败", "豆包响应超时")) or response_text == self.circuit_open_message:
+            return
+        self.response_cache.set(key, response_text)
 
     def is_command_triggered(self, content: str) -> tuple[bool, str]:
         """
-        检查消息是否以命令列表中的命令开头
+        检查消息是否以命令列表中的命令开头(忽略大小写，最长的命令优先)
         
         Args:
             content: 消息内容
@@ -112,28 +2460,41 @@ class Doubao(PluginBase):
         Returns:
             (是否触发命令, 去除命令前缀后的内容)
         """
-        if not content:
-            return False, content
+        return self.command_matcher.match(content)
+
+    def is_irrelevant_message(self, message: dict) -> bool:
+        """在解析消息之前快速判断文本消息是否一定与豆包无关
+        
+        只做命令前缀、@、「查看图片」和会话后续消息的检查，不记录日志。
+        消息格式无法快速判断时返回False，交给完整的处理流程。
+        
+        Args:
+            message: 原始消息字典
             
-        content = content.strip()
+        Returns:
+            bool: 是否可以直接忽略
+        """
+        content = message.get("Content")
+        if content is None:
+            content = message.get("content")
+        if not content or not isinstance(content, str):
+            return False
         
-        for cmd in self.commands:
-            # 忽略大小写比较命令
-            if content.lower().startswith(cmd.lower()):
-                # 返回去除命令前缀后的内容
-                clean_content = content[len(cmd):].strip()
-                return True, clean_content
-                
-            # 处理空格情况，例如"#豆包 "与"#豆包"
-            padded_cmd = f"{cmd} "
-            if content.lower().startswith(padded_cmd.lower()):
-                clean_content = content[len(padded_cmd) - 1:].strip()
-                return True, clean_content
+        if self.command_matcher.has_prefix(content) or "查看图片" in content or content.lstrip()[:1] == "@":
+            return False
+        
+        # 会话有效期内的后续消息无需命令前缀
+        if self.enable_session and len(self.user_sessions):
+            from_id = message.get("SenderWxid") or message.get("FromWxid") or message.get("wxid") or "unknown_user"
+            room_id = (message.get("IsGroup") and message.get("FromWxid")) or message.get("room_wxid") or ""
+            if self.get_session_key(from_id, room_id) in self.user_sessions:
+                return False
         
-        return False, content
+        self.fast_rejected += 1
+        return True
 
     async def save_chat_history(self, from_id: str, prompt: str, response: str, images: list[str], image_details: list[dict] = None):
-        """保存聊天记录
+        """保存聊天记录(放入后台写入队列，不阻塞事件循环)
         
         Args:
             from_id: 发送者ID
@@ -143,7 +2504,6 @@ class Doubao(PluginBase):
             image_details: 图片详细信息列表
         """
         try:
-            history_file = self.plugin_dir / "chat_history.jsonl"
             record = {
                 "timestamp": datetime.now().isoformat(),
                 "from_id": from_id,
@@ -152,15 +2512,121 @@ class Doubao(PluginBase):
                 "images": images,
                 "image_details": image_details or []
             }
-            
-            with open(history_file, "a", encoding="utf-8") as f:
-                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+            self.history_writer.write(record)
                 
         except Exception as e:
             logger.error(f"保存聊天记录失败: {e}")
 
-    async def chat_with_doubao(self, prompt: str) -> tuple[str, list[str]]:
-        """与豆包AI对话"""
+    async def query_chat_history(self, from_id: str, days: int = 7, limit: int = 50) -> list[dict]:
+        """查询用户近期的聊天记录(需要sqlite存储后端)
+        
+        Args:
+            from_id: 用户ID
+            days: 查询最近多少天
+            limit: 最多返回条数
+            
+        Returns:
+            list[dict]: 聊天记录，按时间倒序
+        """
+        store = self.history_writer.store
+        if not isinstance(store, SqliteHistoryStore):
+            logger.warning("查询聊天记录需要将history_backend设置为sqlite")
+            return []
+        since = (datetime.now() - timedelta(days=days)).isoformat()
+        return await asyncio.to_thread(store.recent, from_id, since, limit)
+
+    async def lookup_user_images(self, from_id: str) -> list[dict]:
+        """从聊天记录中查询用户最近一次生成的图片信息(需要sqlite存储后端)
+        
+        与query_chat_history一样供管理命令或其他插件查询历史；「查看图片」使用按群区分的image_selections。
+        
+        Args:
+            from_id: 用户ID
+            
+        Returns:
+            list[dict]: 图片详细信息列表
+        """
+        store = self.history_writer.store
+        if not isinstance(store, SqliteHistoryStore):
+            logger.warning("查询聊天记录需要将history_backend设置为sqlite")
+            return []
+        return await asyncio.to_thread(store.latest_images, from_id)
+
+    async def chat_with_doubao(self, prompt: str, chat_session: dict = None) -> tuple[str, list[str]]:
+        """与豆包AI对话
+        
+        不使用用户会话的请求按提示词合并，相同提示词的并发请求共享同一次对话结果。
+        使用用户会话时不合并，否则只有发起请求的用户的会话能记录新建的会话ID。
+        
+        Args:
+            prompt: 提问内容
+            chat_session: 用户会话，为None时使用账号的共享会话
+            
+        Returns:
+            (完整回复文本, 图片URL列表)
+        """
+        if self.enable_request_coalescing and chat_session is None:
+            return await self._completion_flights.do(
+                normalize_prompt(prompt),
+                lambda: self._collect_chat_reply(prompt, chat_session)
+            )
+        return await self._collect_chat_reply(prompt, chat_session)
+
+    async def _collect_chat_reply(self, prompt: str, chat_session: dict = None) -> tuple[str, list[str]]:
+        """收集流式对话的完整回复，参数与返回值同chat_with_doubao"""
+        collected_text = []
+        image_urls = []
+        
+        async for kind, value in self.stream_chat_with_doubao(prompt, chat_session):
+            if kind == "text":
+                collected_text.append(value)
+            elif kind == "images":
+                image_urls = value
+            else:
+                return value, []
+        
+        response_text = "".join(collected_text)
+        
+        # 如果没有解析到任何文本但有图片，添加一个默认文本
+        if not response_text and image_urls:
+            response_text = DEFAULT_IMAGE_REPLY
+        
+        return response_text, image_urls
+
+    async def stream_chat_with_doubao(self, prompt: str, chat_session: dict = None):
+        """与豆包AI对话(流式)
+        
+        Args:
+            prompt: 提问内容
+            chat_session: 用户会话，为None时使用账号的共享会话
+            
+        Yields:
+            tuple[str, object]: ("text", 文本片段)、("images", 图片URL列表) 或 ("error", 错误信息)。
+            图片列表在文本结束(含轮询)后给出，出错时只给出一条错误信息
+        """
+        # 对话接口熔断期间直接返回，不请求豆包
+        if not self.completion_breaker.allow():
+            logger.warning("对话接口熔断中，跳过请求")
+            self.metrics.inc("doubao_completions_total", result="circuit_open")
+            yield "error", self.circuit_open_message
+            return
+        
+        # 从账号池中选择当前负载最低的账号，用户会话优先使用其绑定的账号
+        account = self.account_pool.acquire(chat_session["account"] if chat_session else None)
+        conversation_id = account.conversation_id
+        section_id = account.section_id
+        create_conversation = False
+        
+        if chat_session is not None:
+            if chat_session["account"] is not account:
+                # 绑定的账号暂停使用时，在新账号上重新创建会话
+                chat_session.update(account=account, conversation_id=None, section_id=None)
+            if chat_session["conversation_id"]:
+                conversation_id = chat_session["conversation_id"]
+                section_id = chat_session["section_id"]
+            else:
+                create_conversation = True
+        
         # 构建URL和请求参数
         base_url = "https://www.doubao.com/samantha/chat/completion"
         
@@ -195,7 +2661,7 @@ class Doubao(PluginBase):
             "accept-language": "zh-CN,zh;q=0.9,en;q=0.8,en-GB;q=0.7,en-US;q=0.6",
             "content-type": "application/json",
             "origin": "https://www.doubao.com",
-            "referer": f"https://www.doubao.com/chat/{self.conversation_id}",
+            "referer": f"https://www.doubao.com/chat/{'' if create_conversation else conversation_id}",
             "user-agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/133.0.0.0 Safari/537.36 Edg/133.0.0.0",
             "agw-js-conv": "str",
             "Host": "www.doubao.com",
@@ -203,8 +2669,8 @@ class Doubao(PluginBase):
             "x-flow-trace": "04-000440f33cc688c00016841ea637c556-001b32e676c188f9-01"
         }
         
-        if self.cookie:
-            headers["cookie"] = self.cookie
+        if account.cookie:
+            headers["cookie"] = account.cookie
         
         # 生成消息ID
         local_message_id = f"{uuid.uuid4()}"
@@ -214,8 +2680,8 @@ class Doubao(PluginBase):
         
         # 构建请求体
         payload = {
-            "conversation_id": self.conversation_id,
-            "section_id": self.section_id,
+            "conversation_id": conversation_id,
+            "section_id": section_id,
             "local_message_id": local_message_id,
             "messages": [
                 {
@@ -233,436 +2699,835 @@ class Doubao(PluginBase):
                 "max_images": 20  # 添加最大图片数量参数
             }
         }
+        
+        # 新的用户会话需要先在豆包创建会话
+        if create_conversation:
+            payload["conversation_id"] = "0"
+            payload["local_conversation_id"] = f"local_{int(time.time() * 1000)}"
+            payload.pop("section_id")
+            payload["completion_option"]["need_create_conversation"] = True
 
-        collected_text = []
-        image_urls = []
+        decoder = DoubaoStreamDecoder()
+        recorded_chunks = [] if self.stream_record_dir else None
+        request_ok = None  # 本次请求结果，调用方取走全部结果后才算成功，None表示不计入熔断和账号统计
+        status = None
+        
+        # 对话请求不超过当前消息的处理截止时间
+        request_kwargs = {}
+        remaining = time_left()
+        if remaining is not None:
+            request_kwargs["timeout"] = aiohttp.ClientTimeout(total=remaining)
         
+        result = "ok"
+        request_start = time.monotonic()
         try:
-            async with aiohttp.ClientSession() as session:
-                async with session.post(base_url, headers=headers, json=payload, params=url_params) as response:
-                    if response.status != 200:
-                        logger.error(f"请求失败: {response.status}")
-                        return f"请求失败: {response.status}", []
-                    
-                    # 用于跟踪图片生成状态
-                    image_generating = False
-                    wait_time = 0
-                    request_status = {
-                        "image_generating": False,
-                        "completed": False,
-                        "images": []
-                    }
-                        
-                    async for line in response.content:
-                        line = line.decode('utf-8', errors='ignore')
-                        if not line.strip():
-                            continue
-                            
-                        if line.startswith('data: '):
-                            data = line[6:]
-                            if data == "[DONE]":
-                                logger.debug("收到[DONE]标记，响应完成")
-                                request_status["completed"] = True
-                                break
-                                
-                            try:
-                                # 解析外层JSON
-                                parsed_data = json.loads(data)
-                                
-                                # 处理event_data字段
-                                if "event_data" in parsed_data:
-                                    event_data_str = parsed_data["event_data"]
-                                    event_type = parsed_data.get("event_type")
-                                    
-                                    try:
-                                        # 解析内层JSON
-                                        event_data = json.loads(event_data_str)
-                                        
-                                        # 检查图片生成状态
-                                        if "status" in event_data and event_data["status"] == "processing":
-                                            image_generating = True
-                                            request_status["image_generating"] = True
-                                            logger.debug("检测到图片生成中...")
-                                        
-                                        # 处理不同类型的事件
-                                        if event_type == 2001:  # 消息事件
-                                            # 检查是否有message字段
-                                            if "message" in event_data:
-                                                message = event_data["message"]
-                                                
-                                                # 检查消息内容
-                                                if "content" in message and "content_type" in message:
-                                                    content_type = message["content_type"]
-                                                    content_str = message["content"]
-                                                    
-                                                    if content_type == 2001 or content_type == 10000:  # 文本内容
-                                                        try:
-                                                            content_obj = json.loads(content_str)
-                                                            if "text" in content_obj:
-                                                                text = content_obj["text"]
-                                                                if text and text.strip():
-                                                                    collected_text.append(text)
-                                                        except:
-                                                            logger.debug(f"解析文本内容错误: {content_str[:100]}")
-                                                    elif content_type == 2010:  # 图片内容
-                                                        try:
-                                                            content_obj = json.loads(content_str)
-                                                            images_extracted = False
-                                                            
-                                                            # 常规图片格式处理
-                                                            if "data" in content_obj and isinstance(content_obj["data"], list):
-                                                                for img_data in content_obj["data"]:
-                                                                    # 提取图片URL
-                                                                    if "image_ori" in img_data and "url" in img_data["image_ori"]:
-                                                                        img_url = img_data["image_ori"]["url"]
-                                                                        logger.debug(f"发现图片URL: {img_url}")
-                                                                        image_urls.append(img_url)
-                                                                        images_extracted = True
-                                                            
-                                                            # 尝试其他可能的图片格式
-                                                            if not images_extracted and "image" in content_obj:
-                                                                img_data = content_obj["image"]
-                                                                if isinstance(img_data, dict) and "url" in img_data:
-                                                                    img_url = img_data["url"]
-                                                                    logger.debug(f"发现备用格式图片URL: {img_url}")
-                                                                    image_urls.append(img_url)
-                                                                    images_extracted = True
-                                                            
-                                                            # 尝试第三种可能的图片格式
-                                                            if not images_extracted and "url" in content_obj:
-                                                                img_url = content_obj["url"]
-                                                                logger.debug(f"发现直接URL图片: {img_url}")
-                                                                image_urls.append(img_url)
-                                                                images_extracted = True
-                                                            
-                                                            if not images_extracted:
-                                                                logger.debug(f"未提取到图片: {content_str[:200]}")
-                                                        except Exception as e:
-                                                            logger.error(f"解析图片内容错误: {e}")
-                                                    elif content_type == 2074:  # 图片集信息
-                                                        try:
-                                                            content_obj = json.loads(content_str)
-                                                            if "creations" in content_obj and isinstance(content_obj["creations"], list):
-                                                                for img_item in content_obj["creations"]:
-                                                                    if "type" in img_item and img_item["type"] == 1 and "image" in img_item:
-                                                                        img_data = img_item["image"]
-                                                                        if "status" in img_data and img_data["status"] == 2:  # 状态2表示图片已完成
-                                                                            # 获取所有可用的图片URL
-                                                                            urls = {}
-                                                                            
-                                                                            # 原始图片
-                                                                            if "image_raw" in img_data and "url" in img_data["image_raw"]:
-                                                                                urls["raw"] = img_data["image_raw"]["url"]
-                                                                            
-                                                                            # 带水印的原图
-                                                                            if "image_ori" in img_data and "url" in img_data["image_ori"]:
-                                                                                urls["original"] = img_data["image_ori"]["url"]
-                                                                            
-                                                                            # 缩略图
-                                                                            if "image_thumb" in img_data and "url" in img_data["image_thumb"]:
-                                                                                urls["thumbnail"] = img_data["image_thumb"]["url"]
-                                                                            
-                                                                            # 原始缩略图
-                                                                            if "image_thumb_ori" in img_data and "url" in img_data["image_thumb_ori"]:
-                                                                                urls["thumbnail_original"] = img_data["image_thumb_ori"]["url"]
-                                                                            
-                                                                            # 默认使用原图URL
-                                                                            primary_url = urls.get("original", urls.get("raw", urls.get("thumbnail", "")))
-                                                                            
-                                                                            if primary_url:
-                                                                                logger.debug(f"2074类型-发现图片: {primary_url}")
-                                                                                image_urls.append(primary_url)
-                                                        except Exception as e:
-                                                            logger.error(f"解析2074类型内容错误: {e}")
-                                        
-                                        # 检查TTS内容（完整文本）
-                                        if "tts_content" in event_data:
-                                            text = event_data["tts_content"]
-                                            if text and text.strip() and not collected_text:
-                                                collected_text.append(text)
-                                    except Exception as e:
-                                        logger.error(f"解析event_data错误: {e}")
-                            except Exception as e:
-                                logger.error(f"解析JSON错误: {e}")
-                    
-                    # 如果正在生成图片但未获取到图片，尝试轮询获取
-                    if (image_generating or request_status["image_generating"]) and not image_urls:
-                        logger.info("检测到图片生成请求，但未获取到图片URL，尝试轮询获取...")
-                        
-                        # 构建获取结果的请求URL
-                        result_url = f"https://www.doubao.com/samantha/chat/{self.conversation_id}/messages"
-                        
-                        # 轮询等待图片生成完成
-                        poll_count = 0
-                        max_polls = 20  # 最多轮询10次
-                        
-                        while poll_count < max_polls and not image_urls:
-                            poll_count += 1
-                            wait_time += 3
-                            logger.debug(f"轮询第{poll_count}次，等待3秒...")
-                            await asyncio.sleep(3)  # 等待3秒
-                            
-                            # 尝试获取图片结果
-                            try:
-                                # 构建获取结果的请求参数
-                                result_params = {
-                                    "aid": "497858",
-                                    "device_id": "7436003167110956563",
-                                    "device_platform": "web",
-                                    "web_id": "7387403790770816553",
-                                    "client_timestamp": int(time.time() * 1000)
-                                }
-                                
-                                # 获取最新消息
-                                async with session.get(result_url, params=result_params, headers=headers) as result_response:
-                                    if result_response.status == 200:
-                                        result_data = await result_response.json()
-                                        logger.debug("获取到最新消息响应")
-                                        
-                                        # 检查是否有消息列表
-                                        if "data" in result_data and "messages" in result_data["data"]:
-                                            messages = result_data["data"]["messages"]
-                                            
-                                            # 查找最新的图片消息
-                                            for msg in messages:
-                                                if "content" in msg and "content_type" in msg:
-                                                    if msg["content_type"] == 2010:  # 图片类型
-                                                        try:
-                                                            content_obj = json.loads(msg["content"])
-                                                            
-                                                            # 检查是否有图片数据
-                                                            if "data" in content_obj and isinstance(content_obj["data"], list):
-                                                                for img_data in content_obj["data"]:
-                                                                    if "image_ori" in img_data and "url" in img_data["image_ori"]:
-                                                                        img_url = img_data["image_ori"]["url"]
-                                                                        
-                                                                        # 检查这个URL是否已经返回过
-                                                                        if img_url not in image_urls:
-                                                                            logger.debug(f"轮询发现新图片: {img_url}")
-                                                                            image_urls.append(img_url)
-                                                        except Exception as e:
-                                                            logger.error(f"轮询解析图片内容错误: {e}")
-                                                    elif msg["content_type"] == 2074:  # 图片集信息
-                                                        try:
-                                                            content_obj = json.loads(msg["content"])
-                                                            if "creations" in content_obj and isinstance(content_obj["creations"], list):
-                                                                for img_item in content_obj["creations"]:
-                                                                    if "type" in img_item and img_item["type"] == 1 and "image" in img_item:
-                                                                        img_data = img_item["image"]
-                                                                        if "status" in img_data and img_data["status"] == 2:
-                                                                            # 优先使用原图URL
-                                                                            if "image_ori" in img_data and "url" in img_data["image_ori"]:
-                                                                                img_url = img_data["image_ori"]["url"]
-                                                                                if img_url not in image_urls:
-                                                                                    logger.debug(f"轮询发现2074类型图片: {img_url}")
-                                                                                    image_urls.append(img_url)
-                                                        except Exception as e:
-                                                            logger.error(f"轮询解析2074类型内容错误: {e}")
-                            except Exception as e:
-                                logger.error(f"轮询请求异常: {e}")
-                            
-                            # 如果已经获取到图片，可以提前结束轮询
-                            if image_urls:
-                                logger.info(f"已获取到{len(image_urls)}张图片，结束轮询")
-                                break
-                        
-                        if not image_urls:
-                            logger.warning(f"轮询结束，未能获取到图片，已等待{wait_time}秒")
+            session = await self.get_http_session()
+            async with session.post(base_url, headers=headers, json=payload, params=url_params, **request_kwargs) as response:
+                status = response.status
+                stream_start = time.monotonic()
+                self.metrics.observe("doubao_upstream_ttfb_seconds", stream_start - request_start)
+                if response.status != 200:
+                    logger.error(f"请求失败: {response.status} (账号: {account.name})")
+                    request_ok = False
+                    yield "error", f"请求失败: {response.status}"
+                    return
+                
+                # 按数据块增量解码，解码器会缓冲跨数据块的事件
+                async for chunk in response.content.iter_any():
+                    if recorded_chunks is not None:
+                        recorded_chunks.append(chunk)
+                    for fragment in decoder.feed(chunk):
+                        yield "text", fragment
+                    if decoder.completed:
+                        logger.debug("收到[DONE]标记，响应完成")
+                        break
+                for fragment in decoder.finish():
+                    yield "text", fragment
+                
+                # 没有文本片段时使用TTS完整文本
+                if not decoder.text_parts and decoder.tts_text:
+                    yield "text", decoder.tts_text
+                
+                if recorded_chunks:
+                    self.record_stream(local_message_id, recorded_chunks)
+                self.metrics.observe("doubao_upstream_stream_seconds", time.monotonic() - stream_start)
+            
+            # 记录新创建的会话ID，未能获取时回退到账号的共享会话
+            if create_conversation:
+                if decoder.conversation_id:
+                    chat_session.update(conversation_id=decoder.conversation_id, section_id=decoder.section_id)
+                    logger.info(f"已创建用户会话: {decoder.conversation_id} (账号: {account.name})")
+                else:
+                    chat_session.update(conversation_id=account.conversation_id, section_id=account.section_id)
+                    logger.warning("未能获取新建的会话ID，使用共享会话")
+                conversation_id = chat_session["conversation_id"]
+            
+            image_urls = decoder.image_urls
             
-            # 如果没有解析到任何文本但有图片，添加一个默认文本
-            if not collected_text and image_urls:
-                collected_text.append("我已经为您生成了图片，请查看。")
+            # 如果正在生成图片但未获取到图片，等待图片生成完成
+            if decoder.image_generating and not image_urls:
+                logger.info("检测到图片生成请求，但未获取到图片URL，等待图片生成完成...")
+                start = time.monotonic()
+                image_urls = await self.wait_for_images(conversation_id, decoder.message_id, headers)
+                self.metrics.observe("doubao_image_poll_seconds", time.monotonic() - start)
+                
+                if image_urls:
+                    logger.info(f"已获取到{len(image_urls)}张图片，等待{time.monotonic() - start:.1f}秒")
+                else:
+                    logger.warning(f"等待结束，未能获取到图片，已等待{time.monotonic() - start:.1f}秒")
+            
+            yield "images", image_urls
+            request_ok = True
+            
+        except asyncio.TimeoutError:
+            # 超时前已收到的文本照常返回，放弃图片
+            result = "timeout"
+            if decoder.text_parts:
+                logger.warning(f"豆包回复超过处理时限，只返回已收到的文本 (账号: {account.name})")
+                yield "images", decoder.image_urls
+                request_ok = True
+            else:
+                logger.error(f"豆包回复超时 (账号: {account.name})")
+                # 排队等待使超时时间明显缩短时，超时不算豆包故障
+                request_ok = None if timeout_cut_by_deadline(remaining, self.request_deadline) else False
+                yield "error", "豆包响应超时，请稍后再试"
+        except (asyncio.CancelledError, GeneratorExit):
+            # 请求被取消，或调用方被取消后关闭了生成器，不计入统计
+            if request_ok is None:
+                result = "cancelled"
+            raise
+        except Exception as e:
+            logger.error(f"与豆包AI对话失败: {e} (账号: {account.name})")
+            request_ok = False
+            result = "error"
+            yield "error", f"对话失败: {str(e)}"
+        finally:
+            self.account_pool.release(account, request_ok, status)
+            if request_ok is None:
+                self.completion_breaker.cancel()
+            else:
+                self.completion_breaker.record(request_ok)
+            if result == "ok" and request_ok is False:
+                result = f"http_{status}"
+            self.metrics.inc("doubao_completions_total", result=result)
+
+    async def wait_for_images(self, conversation_id: str, message_id: str, headers: dict) -> list[str]:
+        """等待会话中的图片生成完成
+        
+        同一会话的所有等待请求共用一个轮询器，轮询间隔按指数退避增长。
+        
+        Args:
+            conversation_id: 会话ID
+            message_id: 本次回复的消息ID，未知时为None
+            headers: 请求头
             
-            return "".join(collected_text), image_urls
+        Returns:
+            list[str]: 图片URL列表，超时仍未完成时返回已完成的部分
+        """
+        poller = self._image_pollers.get(conversation_id)
+        if poller is None:
+            poller = ConversationImagePoller(
+                functools.partial(self._fetch_conversation_messages, conversation_id, headers),
+                initial_delay=self.image_poll_initial_delay,
+                max_delay=self.image_poll_max_delay
+            )
+            self._image_pollers[conversation_id] = poller
+        
+        timeout = time_left(self.image_poll_timeout)
+        if timeout <= 0:
+            logger.warning("已超过处理时限，不再等待图片生成")
+            return []
+        
+        try:
+            return await poller.wait(message_id, timeout)
+        finally:
+            if poller.idle and self._image_pollers.get(conversation_id) is poller:
+                del self._image_pollers[conversation_id]
+
+    async def _fetch_conversation_messages(self, conversation_id: str, headers: dict) -> list[dict]:
+        """获取会话的最新消息列表"""
+        result_url = f"https://www.doubao.com/samantha/chat/{conversation_id}/messages"
+        result_params = {
+            "aid": "497858",
+            "device_id": "7436003167110956563",
+            "device_platform": "web",
+            "web_id": "7387403790770816553",
+            "client_timestamp": int(time.time() * 1000)
+        }
+        
+        session = await self.get_http_session()
+        async with session.get(result_url, params=result_params, headers=headers) as result_response:
+            if result_response.status != 200:
+                raise RuntimeError(f"HTTP错误: {result_response.status}")
+            result_data = await result_response.json(loads=_json_loads)
+        return (result_data.get("data") or {}).get("messages") or []
+
+    async def deliver_streaming_reply(self, bot: WechatAPIClient, target_id: str, prompt: str,
+                                      from_id: str, from_name: str, is_group: bool, is_at: bool,
+                                      chat_session: dict = None) -> tuple[str, list[str], bool]:
+        """流式获取豆包回复，并按句子/段落分块陆续发送到微信
+        
+        Args:
+            bot: 微信API客户端
+            target_id: 发送目标ID
+            prompt: 提问内容
+            from_id: 发送者ID
+            from_name: 发送者昵称
+            is_group: 是否为群聊
+            is_at: 原消息是否@了机器人，仅第一块回复使用@
+            chat_session: 用户会话，为None时使用账号的共享会话
             
+        Returns:
+            (已发送的回复文本, 图片URL列表, 回复是否完整)。中途出错时错误信息单独发送，
+            返回已收到的文本；还没有收到文本时返回错误信息
+        """
+        chunker = StreamReplyChunker(self.stream_min_chunk_size, self.stream_flush_interval)
+        collected_text = []
+        image_urls = []
+        sent_count = 0
+        
+        async for kind, value in self.stream_chat_with_doubao(prompt, chat_session):
+            if kind == "text":
+                collected_text.append(value)
+                chunk = chunker.push(value)
+                if chunk:
+                    await self.send_text_reply(bot, target_id, chunk, from_id, from_name, is_group, is_at and sent_count == 0)
+                    sent_count += 1
+            elif kind == "images":
+                image_urls = value
+            else:
+                if not collected_text:
+                    await self.send_text_reply(bot, target_id, value, from_id, from_name, is_group, is_at)
+                    return value, [], False
+                # 先发完已收到的文本，错误信息单独发送，聊天记录保存用户实际收到的文本
+                chunk = chunker.flush()
+                if chunk:
+                    await self.send_text_reply(bot, target_id, chunk, from_id, from_name, is_group, is_at and sent_count == 0)
+                await self.send_text_reply(bot, target_id, value, from_id, from_name, is_group, False)
+                return "".join(collected_text), [], False
+        
+        response_text = "".join(collected_text)
+        if not response_text and image_urls:
+            response_text = DEFAULT_IMAGE_REPLY
+            chunker.push(response_text)
+        
+        # 发送剩余的文本
+        chunk = chunker.flush()
+        if chunk:
+            await self.send_text_reply(bot, target_id, chunk, from_id, from_name, is_group, is_at and sent_count == 0)
+            sent_count += 1
+        
+        logger.debug(f"流式回复完成: 共发送{sent_count}段")
+        return response_text, image_urls, True
+
+    async def send_text_reply(self, bot: WechatAPIClient, target_id: str, text: str,
+                              from_id: str, from_name: str, is_group: bool, is_at: bool):
+        """发送文本回复，依次尝试不同的API以增强兼容性
+        
+        Args:
+            bot: 微信API客户端
+            target_id: 发送目标ID
+            text: 回复文本
+            from_id: 发送者ID
+            from_name: 发送者昵称
+            is_group: 是否为群聊
+            is_at: 是否使用@回复(仅当原消息是@消息时)
+        """
+        start = time.monotonic()
+        
+        # 在群聊中添加@回复（仅当原消息是@消息时）
+        final_response = text
+        if is_group and from_name and is_at:
+            final_response = f"@{from_name} {text}"
+        
+        try:
+            if is_group:
+                # 尝试使用专用的@消息API（只有原消息是@类型时）
+                if is_at:
+                    try:
+                        await bot.send_at_message(target_id, text, [from_id])
+                    except Exception:
+                        await bot.send_text(target_id, final_response, from_id)
+                else:
+                    # 非@消息直接使用普通文本发送
+                    await bot.send_text(target_id, final_response, None)
+            else:
+                await bot.send_text(target_id, text, None)
+        except Exception:
+            try:
+                await bot.send_text_message(target_id, final_response)
+            except Exception:
+                pass
+        self.metrics.observe("doubao_send_seconds", time.monotonic() - start, kind="text")
+
+    async def send_tip_message(self, bot: WechatAPIClient, target_id: str, text: str):
+        """发送不需要@的提示消息，并记录发送耗时
+        
+        Args:
+            bot: 微信API客户端
+            target_id: 发送目标ID
+            text: 提示文本
+        """
+        start = time.monotonic()
+        try:
+            await bot.send_text_message(target_id, text)
+        finally:
+            self.metrics.observe("doubao_send_seconds", time.monotonic() - start, kind="text")
+
+    async def send_image_reply(self, bot: WechatAPIClient, target_id: str, image_path: str):
+        """读取图片文件并发送
+        
+        Args:
+            bot: 微信API客户端
+            target_id: 发送目标ID
+            image_path: 图片文件路径
+        """
+        image_data = await asyncio.to_thread(Path(image_path).read_bytes)
+        start = time.monotonic()
+        try:
+            await bot.send_image_message(target_id, image_data)
+        finally:
+            self.metrics.observe("doubao_send_seconds", time.monotonic() - start, kind="image")
+
+    def record_stream(self, name: str, chunks: list[bytes]):
+        """将原始对话流保存到录制目录，供解码器基准测试回放
+        
+        Args:
+            name: 录制文件名(不含扩展名)
+            chunks: 按接收顺序排列的原始数据块
+        """
+        try:
+            record_dir = self.plugin_dir / self.stream_record_dir
+            record_dir.mkdir(parents=True, exist_ok=True)
+            with open(record_dir / f"{name}.sse", "wb") as f:
+                for chunk in chunks:
+                    f.write(chunk)
         except Exception as e:
-            logger.error(f"与豆包AI对话失败: {e}")
-            return f"对话失败: {str(e)}", []
+            logger.error(f"录制对话流失败: {e}")
+
+    async def download_image_to_file(self, url: str, image_path: Path, max_retries: int = 3) -> tuple[str, int]:
+        """下载图片并边接收边写入文件，同时计算内容摘要，不在内存中保留完整图片
+        
+        Args:
+            url: 图片URL
+            image_path: 保存路径
+            max_retries: 最大重试次数
+            
+        Returns:
+            tuple[str, int]: (内容的sha256, 字节数)，下载失败时返回None
+        """
+        async def save_image(response):
+            size = 0
+            digest = hashlib.sha256()
+            with open(image_path, "wb") as f:
+                async for chunk in response.content.iter_chunked(64 * 1024):
+                    f.write(chunk)
+                    digest.update(chunk)
+                    size += len(chunk)
+            logger.debug("图片下载成功: {} 字节", size)
+            
+            # 在工作池中验证图片数据是否有效
+            try:
+                await self.run_in_render_pool(verify_image_file, str(image_path))
+            except Exception as e:
+                raise ValueError(e)
+            return digest.hexdigest(), size
+        
+        result = await self._download_with_retries(url, save_image, max_retries)
+        if result:
+            return result
+        
+        # 删除下载失败留下的残缺文件
+        try:
+            image_path.unlink(missing_ok=True)
+        except Exception:
+            pass
+        return None
 
-    async def download_image(self, url: str, max_retries: int = 3) -> bytes:
-        """下载图片
+    async def _download_with_retries(self, url: str, handle_response, max_retries: int = 3):
+        """带重试的图片下载
         
         Args:
             url: 图片URL
+            handle_response: 处理成功响应的协程函数，图片数据无效时抛出ValueError
             max_retries: 最大重试次数
             
         Returns:
-            bytes: 图片二进制数据
+            handle_response的返回值，全部失败时返回None
         """
         retries = 0
         last_error = None
+        breaker = self.get_cdn_breaker(url)
         
         while retries < max_retries:
+            # 每次尝试最多30秒，且不超过当前消息的处理截止时间
+            remaining = time_left(30)
+            if remaining <= 0:
+                last_error = "超过处理时限"
+                break
+            
+            # 图片CDN熔断期间不再请求
+            if not breaker.allow():
+                last_error = f"{breaker.name} 熔断中"
+                break
+            
+            attempt_ok = False  # 本次请求结果，None表示不计入熔断统计
             try:
-                logger.debug(f"开始下载图片: {url[:100]}{'...' if len(url) > 100 else ''}")
-                timeout = aiohttp.ClientTimeout(total=30)  # 30秒超时
+                logger.opt(lazy=True).debug("开始下载图片: {}", lambda: url[:100] + ("..." if len(url) > 100 else ""))
+                timeout = aiohttp.ClientTimeout(total=remaining)
                 
-                headers = {
-                    "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/133.0.0.0 Safari/537.36",
-                    "Accept": "image/webp,image/apng,image/*,*/*;q=0.8",
-                    "Referer": "https://www.doubao.com/"
-                }
-                
-                async with aiohttp.ClientSession(timeout=timeout) as session:
-                    async with session.get(url, headers=headers) as response:
-                        if response.status == 200:
-                            content_type = response.headers.get("content-type", "")
-                            if content_type.startswith("image/"):
-                                data = await response.read()
-                                logger.debug(f"图片下载成功: {len(data)} 字节")
-                                
-                                # 验证图片数据是否有效
-                                try:
-                                    with io.BytesIO(data) as img_data:
-                                        img = Image.open(img_data)
-                                        img.verify()  # 验证图片完整性
-                                    return data
-                                except Exception as e:
-                                    logger.error(f"下载的图片数据无效: {e}")
-                                    # 继续重试
-                                    retries += 1
-                                    last_error = f"图片数据无效: {e}"
-                            else:
-                                logger.error(f"下载的内容不是图片, Content-Type: {content_type}")
+                session = await self.get_http_session()
+                async with session.get(url, headers=IMAGE_REQUEST_HEADERS, timeout=timeout) as response:
+                    if response.status == 200:
+                        content_type = response.headers.get("content-type", "")
+                        if content_type.startswith("image/"):
+                            try:
+                                result = await handle_response(response)
+                                attempt_ok = True
+                                return result
+                            except ValueError as e:
+                                logger.error(f"下载的图片数据无效: {e}")
+                                # 继续重试
                                 retries += 1
-                                last_error = f"非图片内容类型: {content_type}"
+                                last_error = f"图片数据无效: {e}"
                         else:
-                            logger.error(f"下载图片失败，HTTP状态码: {response.status}")
+                            logger.error(f"下载的内容不是图片, Content-Type: {content_type}")
                             retries += 1
-                            last_error = f"HTTP错误: {response.status}"
+                            last_error = f"非图片内容类型: {content_type}"
+                    else:
+                        logger.error(f"下载图片失败，HTTP状态码: {response.status}")
+                        retries += 1
+                        last_error = f"HTTP错误: {response.status}"
             except asyncio.TimeoutError:
                 logger.error(f"下载图片超时")
                 retries += 1
                 last_error = "请求超时"
+                if timeout_cut_by_deadline(remaining, 30):
+                    # 因处理时限缩短了超时时间，不算CDN故障
+                    attempt_ok = None
             except Exception as e:
                 logger.error(f"下载图片异常: {e}")
                 retries += 1
                 last_error = str(e)
+            except asyncio.CancelledError:
+                attempt_ok = None
+                raise
+            finally:
+                if attempt_ok is None:
+                    breaker.cancel()
+                else:
+                    breaker.record(attempt_ok)
+            
+            # 如果需要重试，等待一段时间
+            if retries < max_retries:
+                wait_time = time_left(retries * 2)  # 按重试次数递增等待时间
+                logger.debug("等待 {:.1f} 秒后重试下载图片", wait_time)
+                await asyncio.sleep(wait_time)
+        
+        logger.error(f"下载图片失败，已尝试 {retries} 次: {last_error}")
+        return None
+
+    async def download_images(self, image_urls: list[str]) -> list[dict]:
+        """并发下载所有图片到缓存目录，并发数受download_concurrency限制
+        
+        同一组图片的并发下载请求共享同一次下载结果。
+        
+        Args:
+            image_urls: 图片URL列表
+            
+        Returns:
+            list[dict]: 下载成功的图片信息，按原始序号排列
+        """
+        if self.enable_request_coalescing:
+            return await self._download_flights.do(tuple(image_urls), lambda: self._download_images(image_urls))
+        return await self._download_images(image_urls)
+
+    async def _download_images(self, image_urls: list[str]) -> list[dict]:
+        """下载一组图片，参数与返回值同download_images"""
+        if self._download_semaphore is None:
+            self._download_semaphore = asyncio.Semaphore(self.download_concurrency)
+        
+        async def fetch(i: int, img_url: str):
+            # 已缓存的图片直接使用，不再请求网络
+            image_path = self.image_file_cache.get(img_url)
+            if image_path:
+                logger.debug("图片 #{} 命中缓存: {}", i + 1, image_path)
+                self.metrics.inc("doubao_image_downloads_total", result="cache_hit")
+                return {
+                    "number": i + 1,
+                    "path": image_path,
+                    "url": img_url,
+                    "description": f"图片 #{i+1}",
+                    "elapsed": 0.0
+                }
+            
+            temp_path = self.cache_dir / f"doubao_tmp_{uuid.uuid4().hex}.part"
+            async with self._download_semaphore:
+                start = time.monotonic()
+                try:
+                    result = await self.download_image_to_file(img_url, temp_path)
+                    if result:
+                        image_path = self.image_file_cache.add(img_url, temp_path, *result)
+                except Exception as e:
+                    logger.error(f"处理图片 #{i+1} 时出错: {e}")
+                    temp_path.unlink(missing_ok=True)
+                    image_path = None
+                elapsed = time.monotonic() - start
+            
+            self.metrics.observe("doubao_image_download_seconds", elapsed)
+            if not image_path:
+                logger.warning(f"图片 #{i+1} 下载失败，耗时{elapsed:.2f}秒")
+                self.metrics.inc("doubao_image_downloads_total", result="failed")
+                return None
+            self.metrics.inc("doubao_image_downloads_total", result="ok")
+            
+            logger.debug("保存图片 #{}: {}，耗时{:.2f}秒", i + 1, image_path, elapsed)
+            return {
+                "number": i + 1,
+                "path": image_path,
+                "url": img_url,
+                "description": f"图片 #{i+1}",
+                "elapsed": round(elapsed, 3)
+            }
+        
+        start = time.monotonic()
+        results = await asyncio.gather(*(fetch(i, url) for i, url in enumerate(image_urls)))
+        saved_images = [info for info in results if info]
+        
+        logger.info(
+            f"图片下载完成: 成功{len(saved_images)}/{len(image_urls)}张，总耗时{time.monotonic() - start:.2f}秒，"
+            f"单张耗时: {[info['elapsed'] for info in saved_images]}"
+        )
+        return saved_images
+
+    async def check_user_limit(self, user_id: str, is_image_request: bool = False) -> bool:
+        """检查用户是否超出每日限制，未超出时计入一次
+        
+        Args:
+            user_id: 用户ID
+            is_image_request: 是否为图片查看请求，如果是则不计入限制
+            
+        Returns:
+            bool: 是否允许对话
+        """
+        # 图片查看请求不计入限制
+        if is_image_request:
+            return True
+            
+        # 管理员不受限制
+        if user_id in self.admin_list:
+            return True
+        
+        try:
+            allowed = self.quota_store.try_consume(user_id, self.daily_limit)
+            
+            # 累计修改达到阈值时在后台写入文件
+            if self.quota_store.needs_flush:
+                self.run_background(self.quota_store.flush())
+            
+            return allowed
+            
+        except Exception as e:
+            logger.error(f"检查用户限制时出错: {e}")
+            return True  # 出错时默认允许
+
+    def start_request_deadline(self):
+        """为当前消息设置处理截止时间
+        
+        之后的排队、对话、图片轮询、下载和网格渲染都以此为限，超时的步骤会被取消。
+        """
+        if self.request_deadline > 0:
+            _request_deadline.set(time.monotonic() + self.request_deadline)
+
+    async def acquire_request_slot(self, from_id: str, room_id: str) -> bool:
+        """排队获取调用豆包的名额，调用结束后需调用request_scheduler.release()
+        
+        群聊之间、群内用户之间轮流获得名额，管理员优先；被拒绝时退还本次计入的对话次数。
+        
+        Args:
+            from_id: 发送者ID
+            room_id: 群聊ID，私聊为空
+            
+        Returns:
+            bool: 是否获得名额
+        """
+        is_admin = self.is_admin(from_id)
+        try:
+            if await asyncio.wait_for(self.request_scheduler.acquire(room_id or from_id, from_id, is_admin), time_left()):
+                return True
+        except asyncio.TimeoutError:
+            logger.warning(f"用户 {from_id} 的请求排队超过处理时限")
+        
+        logger.warning(f"请求排队过多，拒绝用户 {from_id} 的请求，当前排队: {self.request_scheduler.queued}")
+        if not is_admin:
+            self.quota_store.refund(from_id)
+        return False
+
+    def get_remaining_quota(self, user_id: str) -> int:
+        """查询用户今日剩余对话次数
+        
+        Args:
+            user_id: 用户ID
+            
+        Returns:
+            int: 剩余次数，管理员不受限制时返回-1
+        """
+        if user_id in self.admin_list:
+            return -1
+        return self.quota_store.remaining(user_id, self.daily_limit)
+
+    @schedule('interval', seconds=60)
+    async def flush_user_limits(self, bot: WechatAPIClient):
+        """定期将每日对话次数写入文件"""
+        await self.quota_store.flush()
+
+    @schedule('interval', seconds=60)
+    async def flush_image_selections(self, bot: WechatAPIClient):
+        """定期将用户最近生成的图片记录写入文件"""
+        await self.image_selections.flush()
+
+    def run_background(self, coro):
+        """在后台运行协程，并保留任务引用直到完成
+        
+        Args:
+            coro: 要运行的协程
             
-            # 如果需要重试，等待一段时间
-            if retries < max_retries:
-                wait_time = retries * 2  # 按重试次数递增等待时间
-                logger.debug(f"等待 {wait_time} 秒后重试下载图片")
-                await asyncio.sleep(wait_time)
+        Returns:
+            asyncio.Task: 后台任务
+        """
+        task = asyncio.create_task(coro)
+        self._background_tasks.add(task)
+        task.add_done_callback(self._background_tasks.discard)
+        return task
+
+    def add_stage_hook(self, hook):
+        """注册回复流水线的阶段耗时回调
         
-        logger.error(f"下载图片失败，已重试 {max_retries} 次: {last_error}")
-        return None
+        Args:
+            hook: 同步函数 hook(stage, elapsed, ctx)，每个阶段结束时调用，
+                  stage为normalize/admit/complete/fetch_media/render/deliver/record之一
+        """
+        self.stage_hooks.append(hook)
 
-    async def check_user_limit(self, user_id: str, is_image_request: bool = False) -> bool:
-        """检查用户是否超出每日限制
+    def _record_stage(self, stage: str, elapsed: float, ctx: ReplyContext):
+        """累计阶段耗时并通知回调"""
+        ctx.timings[stage] = ctx.timings.get(stage, 0.0) + elapsed
+        for hook in self.stage_hooks:
+            try:
+                hook(stage, elapsed, ctx)
+            except Exception as e:
+                logger.error(f"阶段回调出错({stage}): {e}")
+
+    async def _run_stage(self, stage: str, ctx: ReplyContext, func):
+        """执行流水线的一个阶段并记录耗时
         
         Args:
-            user_id: 用户ID
-            is_image_request: 是否为图片查看请求，如果是则不计入限制
+            stage: 阶段名
+            ctx: 回复上下文
+            func: 阶段的协程函数 func(ctx)
             
         Returns:
-            bool: 是否允许对话
+            func的返回值
         """
-        # 图片查看请求不计入限制
-        if is_image_request:
-            return True
-            
-        # 管理员不受限制
-        if user_id in self.admin_list:
+        start = time.monotonic()
+        try:
+            return await func(ctx)
+        finally:
+            self._record_stage(stage, time.monotonic() - start, ctx)
+
+    async def run_reply_pipeline(self, ctx: ReplyContext):
+        """回复流水线，文本消息和引用消息共用
+        
+        各处理入口完成消息解析(normalize)后调用，依次执行：
+        admit(回复缓存、熔断、次数限制、排队) → complete(调用豆包) → deliver(发送文本)
+        → fetch_media(下载图片) → render(拼接网格图) → deliver(发送图片) → record(保存聊天记录)
+        
+        Args:
+            ctx: 回复上下文
+        """
+        self._record_stage("normalize", time.monotonic() - ctx.message.received_at, ctx)
+        
+        # 从这里开始计算本条消息的处理时限
+        self.start_request_deadline()
+        
+        if not await self._run_stage("admit", ctx, self._admit_reply):
+            return
+        if not ctx.from_cache:
+            await self._run_stage("complete", ctx, self._complete_reply)
+        await self._run_stage("deliver", ctx, self._deliver_text)
+        
+        if ctx.image_urls:
+            await self._run_stage("fetch_media", ctx, self._fetch_reply_media)
+            if len(ctx.saved_images) > 1:
+                await self._run_stage("render", ctx, self._render_reply_grid)
+            await self._run_stage("deliver", ctx, self._deliver_images)
+        
+        await self._run_stage("record", ctx, self._record_reply)
+        
+        logger.info(
+            f"豆包任务完成: 回复长度:{len(ctx.response_text)}, 图片:{len(ctx.image_urls)}张, "
+            f"耗时: {', '.join(f'{stage}={elapsed:.2f}s' for stage, elapsed in ctx.timings.items())}"
+        )
+
+    async def _admit_reply(self, ctx: ReplyContext) -> bool:
+        """准入阶段：命中回复缓存时直接使用，否则检查熔断、次数限制并排队获取名额
+        
+        Returns:
+            bool: 是否继续处理，返回True且未命中缓存时已占用一个排队名额
+        """
+        # 命中回复缓存时直接回复，不消耗对话次数。已有上下文的会话不使用缓存
+        chat_session = self.get_chat_session(self.get_session_key(ctx.from_id, ctx.room_id))
+        ctx.use_response_cache = chat_session is None or not chat_session["conversation_id"]
+        cached_response = self.get_cached_response(ctx.prompt) if ctx.use_response_cache else None
+        if cached_response:
+            logger.info(f"命中回复缓存: '{ctx.prompt[:50]}'")
+            ctx.response_text = cached_response
+            ctx.from_cache = True
             return True
-            
-        today = datetime.now().strftime('%Y-%m-%d')
-        limit_file = self.plugin_dir / "user_limits.json"
         
+        # 对话接口熔断期间直接回复，不消耗对话次数
+        if not self.completion_breaker.available:
+            logger.info(f"对话接口熔断中，快速回复用户 {ctx.from_id}")
+            self.metrics.inc("doubao_rejections_total", reason="circuit_open")
+            await self.send_text_reply(ctx.bot, ctx.target_id, self.circuit_open_message,
+                                       ctx.from_id, ctx.from_name, ctx.is_group, ctx.is_at)
+            return False
+        
+        # 检查用户限制
+        if not await self.check_user_limit(ctx.from_id):
+            logger.info(f"用户 {ctx.from_id} 已达到今日限制 {self.daily_limit} 次")
+            self.metrics.inc("doubao_rejections_total", reason="quota")
+            await self.send_text_reply(ctx.bot, ctx.target_id, f"您今日的对话次数已达上限({self.daily_limit}次)，请明天再试",
+                                       ctx.from_id, ctx.from_name, ctx.is_group, ctx.is_at)
+            return False
+        
+        # 排队等待处理名额，排队过多时礼貌拒绝
+        if not await self.acquire_request_slot(ctx.from_id, ctx.room_id):
+            self.metrics.inc("doubao_rejections_total", reason="busy")
+            await self.send_text_reply(ctx.bot, ctx.target_id, self.busy_message,
+                                       ctx.from_id, ctx.from_name, ctx.is_group, ctx.is_at)
+            return False
+        return True
+
+    async def _complete_reply(self, ctx: ReplyContext):
+        """对话阶段：调用豆包获取回复，流式模式下文本会边生成边发送，结束后归还排队名额"""
+        logger.info(f"调用豆包: '{ctx.prompt[:50]}{'...' if len(ctx.prompt) > 50 else ''}'")
         try:
-            if limit_file.exists():
-                with open(limit_file, "r", encoding="utf-8") as f:
-                    limits = json.load(f)
+            chat_session = self.get_chat_session(self.get_session_key(ctx.from_id, ctx.room_id), create=True)
+            if self.stream_reply:
+                ctx.response_text, ctx.image_urls, completed = await self.deliver_streaming_reply(
+                    ctx.bot, ctx.target_id, ctx.prompt, ctx.from_id, ctx.from_name, ctx.is_group, ctx.is_at, chat_session
+                )
+                ctx.text_delivered = True
+                # 中途出错时只收到部分回复，不缓存
+                ctx.use_response_cache = ctx.use_response_cache and completed
             else:
-                limits = {}
-                
-            # 清理过期数据
-            limits = {k: v for k, v in limits.items() if k.startswith(today)}
-            
-            # 检查用户限制
-            user_key = f"{today}_{user_id}"
-            current_count = limits.get(user_key, 0)
-            
-            if current_count >= self.daily_limit:
-                return False
-                
-            # 更新使用次数
-            limits[user_key] = current_count + 1
-            
-            # 保存更新
-            with open(limit_file, "w", encoding="utf-8") as f:
-                json.dump(limits, f, indent=2, ensure_ascii=False)
-                
-            return True
+                ctx.response_text, ctx.image_urls = await self.chat_with_doubao(ctx.prompt, chat_session)
+        finally:
+            self.request_scheduler.release()
+        
+        if ctx.use_response_cache:
+            self.cache_response(ctx.prompt, ctx.response_text, ctx.image_urls)
+        
+        # 记录图片URL信息，用于调试
+        if ctx.image_urls:
+            logger.info(f"获取到{len(ctx.image_urls)}张图片URL")
+            logger.opt(lazy=True).debug("图片URL: {}", lambda: "\n".join(
+                f"#{i+1} {url[:100]}{'...' if len(url) > 100 else ''}" for i, url in enumerate(ctx.image_urls)
+            ))
+        else:
+            logger.info("未获取到任何图片URL")
+
+    async def _deliver_text(self, ctx: ReplyContext):
+        """发送阶段(文本)：发送回复文本，流式模式下已经发送过"""
+        if not ctx.response_text:
+            return
+        logger.info(f"豆包回复: '{ctx.response_text[:50]}{'...' if len(ctx.response_text) > 50 else ''}' 图片数: {len(ctx.image_urls)}")
+        if not ctx.text_delivered:
+            await self.send_text_reply(ctx.bot, ctx.target_id, ctx.response_text,
+                                       ctx.from_id, ctx.from_name, ctx.is_group, ctx.is_at)
+            ctx.text_delivered = True
+
+    async def _fetch_reply_media(self, ctx: ReplyContext):
+        """获取图片阶段：并发下载所有图片，并记录为用户最近生成的图片"""
+        ctx.saved_images = await self.download_images(ctx.image_urls)
+        if ctx.saved_images:
+            self.image_selections.set(ctx.from_id, ctx.room_id, ctx.saved_images)
+
+    async def _render_reply_grid(self, ctx: ReplyContext):
+        """渲染阶段：多张图片时拼接网格图，失败时由发送阶段回退到发送单张图片"""
+        # 每张网格图使用唯一文件名，同一秒内为不同会话渲染的网格图不会互相覆盖
+        grid_path = self.cache_dir / f"doubao_grid_{uuid.uuid4().hex}.jpg"
+        try:
+            ctx.grid_path = await self.create_image_grid_async(
+                [image_info["path"] for image_info in ctx.saved_images],
+                str(grid_path),
+                grid_size=grid_size_for(len(ctx.saved_images)),
+                gap=4,
+                img_size=(800, 800)
+            )
+        except Exception as e:
+            logger.error(f"创建网格图片时出错: {e}")
+
+    async def _deliver_images(self, ctx: ReplyContext):
+        """发送阶段(图片)：单张图片直接发送高清图，多张发送网格图，网格图不可用时随机发送一张"""
+        saved_images = ctx.saved_images
+        if not saved_images:
+            return
+        
+        try:
+            if len(saved_images) == 1:
+                # 只有一张图片时，直接发送高清图片
+                await self.send_image_reply(ctx.bot, ctx.target_id, saved_images[0]["path"])
+                logger.info(f"已发送单张高清图片给用户 {ctx.from_id}")
+                return
             
+            if ctx.grid_path:
+                await self.send_image_reply(ctx.bot, ctx.target_id, ctx.grid_path)
+                tip_message = f"我生成了 {len(saved_images)} 张图片，发送「查看图片 序号」即可查看高清大图，例如：查看图片 1"
+                await self.send_tip_message(ctx.bot, ctx.target_id, tip_message)
+                logger.info(f"已发送网格图片和提示消息给用户 {ctx.from_id}")
+                return
         except Exception as e:
-            logger.error(f"检查用户限制时出错: {e}")
-            return True  # 出错时默认允许
+            logger.error(f"发送图片时出错: {e}")
+            if len(saved_images) == 1:
+                return
+        
+        # 网格图片不可用时，随机发送一张图片
+        try:
+            random_img = random.choice(saved_images)
+            await self.send_image_reply(ctx.bot, ctx.target_id, random_img["path"])
+            tip_message = f"我生成了 {len(saved_images)} 张图片，可以发送「查看图片 序号」查看其他图片，例如：查看图片 1"
+            await self.send_tip_message(ctx.bot, ctx.target_id, tip_message)
+            logger.info(f"已发送单张图片和提示消息给用户 {ctx.from_id}")
+        except Exception as e:
+            logger.error(f"发送单张图片时出错: {e}")
+
+    async def _record_reply(self, ctx: ReplyContext):
+        """记录阶段：保存聊天记录"""
+        await self.save_chat_history(ctx.from_id, ctx.prompt, ctx.response_text, ctx.image_urls, ctx.saved_images)
 
     @on_text_message(priority=50)
     @on_at_message(priority=50)
     async def handle_text(self, bot: WechatAPIClient, message: dict):
         """处理文本消息和@消息"""
+        # 绝大多数群消息与豆包无关，在解析和记录日志之前直接忽略
+        if not self.enable or self.is_irrelevant_message(message):
+            return
+        
+        received_at = time.monotonic()
+        deadline_token = _request_deadline.set(None)
         try:
-            # 如果插件未启用，直接返回
-            if not self.enable:
-                return
-                
             # 初始化机器人wxid(如果尚未初始化)
             if not self.bot_wxid and not self.initialized_wxid:
                 await self.initialize_bot_wxid(bot)
             
-            # 正确提取消息内容、发送者和群组信息
-            content = ""
-            from_id = ""
-            room_id = ""
-            
-            # 兼容不同格式的消息结构
-            if "Content" in message:
-                content = str(message["Content"]).strip()
-            elif "content" in message:
-                content = str(message["content"]).strip()
-                
-            # 获取发送者ID - 兼容不同格式
-            if "SenderWxid" in message:
-                from_id = message["SenderWxid"]
-            elif "FromWxid" in message:
-                from_id = message["FromWxid"]
-            elif "wxid" in message:
-                from_id = message["wxid"]
-                
-            # 获取群聊ID - 兼容不同格式
-            if "IsGroup" in message and message["IsGroup"] and "FromWxid" in message:
-                room_id = message["FromWxid"]
-                # 如果是群聊，发送者ID可能需要重新赋值
-                if "SenderWxid" in message:
-                    from_id = message["SenderWxid"]
-            elif "room_wxid" in message:
-                room_id = message["room_wxid"]
-                
-            # 检查消息格式是否正确解析
-            if not content:
-                # 尝试从其他可能的字段获取内容
-                for field in ["msg", "text", "message", "Message"]:
-                    if field in message:
-                        content = str(message[field]).strip()
-                        break
-                
-            if not from_id:
-                from_id = "unknown_user"
-                
-            # 获取发送者昵称
-            from_name = ""
-            if "FromName" in message:
-                from_name = message["FromName"]
-            elif "sender_name" in message:
-                from_name = message["sender_name"]
-                
-            # 检查是否为群聊
-            is_group = bool(room_id)
+            # 解析消息，之后的处理都使用解析结果
+            msg = MessageEnvelope.parse(message, self.bot_wxid, received_at)
+            from_id, room_id, is_group = msg.sender_id, msg.room_id, msg.is_group
             
             # 记录简化的消息日志
-            logger.info(f"收到{'群聊' if is_group else '私聊'}消息: 来自:{from_id} 内容:{content[:50]}{'...' if len(content) > 50 else ''}")
+            logger.info(f"收到{'群聊' if is_group else '私聊'}消息: 来自:{from_id} 内容:{msg.content[:50]}{'...' if len(msg.content) > 50 else ''}")
             
             # 检查群聊/私聊开关
             if is_group and not self.group_chat:
@@ -675,235 +3540,29 @@ class Doubao(PluginBase):
                 return
                 
             # 处理查看图片请求
-            if await self.process_image_request(bot, message, content):
+            if await self.process_image_request(bot, msg):
                 return
-                
-            # 移除群聊@检查逻辑，改为直接检查命令前缀
-            if is_group:
-                # 记录@信息但不作为必要条件
-                is_at = False
-                
-                # 检查不同格式的@标记
-                if "is_at" in message and message["is_at"]:
-                    is_at = True
-                elif "IsAt" in message and message["IsAt"]:
-                    is_at = True
-                elif "AtWxidList" in message and message["AtWxidList"] and self.bot_wxid in message["AtWxidList"]:
-                    is_at = True
-                elif "Ats" in message and message["Ats"] and self.bot_wxid in message["Ats"]:
-                    is_at = True
-                    
-                # 如果是@消息，移除@前缀
-                if is_at and content.startswith(f"@{message.get('bot_name', '')}"):
-                    content = content.replace(f"@{message.get('bot_name', '')}", "").strip()
+            
+            # 不要求@机器人，@消息已去除@前缀，直接检查命令前缀
+            content = msg.text
             
             # 检查是否触发命令
             is_triggered, clean_content = self.is_command_triggered(content)
             
+            # 会话有效期内的后续消息无需命令前缀
+            session_key = self.get_session_key(from_id, room_id)
+            if not is_triggered and content and self.get_chat_session(session_key) is not None:
+                is_triggered, clean_content = True, content
+            
             # 输出命令检查结果
             if is_triggered:
                 logger.info(f"触发豆包: 命令:{content[:20]} → 内容:{clean_content[:50]}")
             else:
                 return
             
-            # 检查用户限制
-            if not await self.check_user_limit(from_id):
-                logger.info(f"用户 {from_id} 已达到今日限制 {self.daily_limit} 次")
-                
-                # 确定发送目标
-                target_id = room_id if is_group else from_id
-                
-                # 尝试不同的API发送消息，增强兼容性
-                try:
-                    await bot.send_text(
-                        target_id,
-                        f"您今日的对话次数已达上限({self.daily_limit}次)，请明天再试",
-                        from_id if is_group else None
-                    )
-                except Exception as e1:
-                    try:
-                        await bot.send_text_message(
-                            target_id,
-                            f"您今日的对话次数已达上限({self.daily_limit}次)，请明天再试"
-                        )
-                    except Exception:
-                        pass
-                return
-                
-            # 发送正在处理的提示
-            target_id = room_id if is_group else from_id
-            
-            # 调用豆包AI获取回复
-            logger.info(f"调用豆包: '{clean_content[:50]}{'...' if len(clean_content) > 50 else ''}'")
-            response_text, image_urls = await self.chat_with_doubao(clean_content)
-            
-            # 记录图片URL信息，用于调试
-            if image_urls:
-                logger.info(f"获取到{len(image_urls)}张图片URL")
-                for i, url in enumerate(image_urls):
-                    logger.debug(f"图片 #{i+1} URL: {url[:100]}{'...' if len(url) > 100 else ''}")
-            else:
-                logger.info("未获取到任何图片URL")
-            
-            # 图片详细信息，在处理图片后填充
-            image_details = []
-            
-            # 发送回复文本(如果有)
-            if response_text:
-                # 记录AI回复
-                logger.info(f"豆包回复: '{response_text[:50]}{'...' if len(response_text) > 50 else ''}' 图片数: {len(image_urls)}")
-                
-                # 在群聊中添加@回复（仅当原消息是@消息时）
-                final_response = response_text
-                if is_group and from_name and is_at:
-                    final_response = f"@{from_name} {response_text}"
-                elif is_group and from_name:
-                    # 不是@消息但依然在群里，可以选择性地添加用户昵称
-                    final_response = f"{response_text}"
-                
-                # 尝试不同的API发送回复，增强兼容性
-                try:
-                    if is_group:
-                        # 尝试使用专用的@消息API（只有原消息是@类型时）
-                        if is_at:
-                            try:
-                                await bot.send_at_message(target_id, response_text, [from_id])
-                            except Exception:
-                                await bot.send_text(target_id, final_response, from_id if is_group else None)
-                        else:
-                            # 非@消息直接使用普通文本发送
-                            await bot.send_text(target_id, final_response, None)
-                    else:
-                        await bot.send_text(target_id, response_text, None)
-                except Exception:
-                    try:
-                        await bot.send_text_message(target_id, final_response)
-                    except Exception:
-                        pass
-            
-            # 处理图片 - 如果有图片，保存并创建网格图片
-            if image_urls:
-                saved_images = []
-                saved_image_paths = []
-                
-                # 下载并保存所有图片
-                for i, img_url in enumerate(image_urls):
-                    try:
-                        # 下载图片
-                        image_data = await self.download_image(img_url)
-                        if image_data:
-                            # 生成文件名
-                            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-                            random_str = ''.join(random.choices('abcdefghijklmnopqrstuvwxyz0123456789', k=8))
-                            image_path = self.cache_dir / f"doubao_img_{timestamp}_{random_str}_{i+1}.jpg"
-                            
-                            # 保存图片
-                            with open(image_path, "wb") as f:
-                                f.write(image_data)
-                                
-                            # 记录图片信息
-                            image_info = {
-                                "number": i + 1,
-                                "path": str(image_path),
-                                "url": img_url,
-                                "description": f"图片 #{i+1}"
-                            }
-                            
-                            saved_images.append(image_info)
-                            saved_image_paths.append(str(image_path))
-                            # 添加到详细信息列表
-                            image_details.append(image_info)
-                            logger.debug(f"保存图片 #{i+1}: {image_path}")
-                    except Exception as e:
-                        logger.error(f"处理图片 #{i+1} 时出错: {e}")
-                
-                # 调用清理缓存方法，保留最新的25张图片
-                await self.clean_image_cache(25)
-                
-                # 缓存用户的图片信息
-                if saved_images:
-                    self.image_cache[from_id] = saved_images
-                    
-                    # 只有一张图片时，直接发送高清图片
-                    if len(saved_images) == 1:
-                        try:
-                            # 读取图片数据
-                            image_path = saved_images[0]["path"]
-                            with open(image_path, "rb") as f:
-                                image_data = f.read()
-                            
-                            # 发送单张图片
-                            await bot.send_image_message(target_id, image_data)
-                            logger.info(f"已发送单张高清图片给用户 {from_id}")
-                        except Exception as e:
-                            logger.error(f"发送单张图片时出错: {e}")
-                    # 多张图片时，创建网格图片
-                    else:
-                        try:
-                            # 计算合适的网格大小
-                            n_images = len(saved_image_paths)
-                            if n_images <= 2:
-                                grid_size = (n_images, 1)  # 1行，n列
-                            elif n_images <= 4:
-                                grid_size = (2, 2)  # 2行2列
-                            elif n_images <= 6:
-                                grid_size = (3, 2)  # 2行3列
-                            elif n_images <= 9:
-                                grid_size = (3, 3)  # 3行3列
-                            else:
-                                grid_size = (4, (n_images + 3) // 4)  # 4列，行数根据图片数量计算
-                                
-                            # 生成网格图片文件名
-                            grid_timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-                            grid_filename = f"doubao_grid_{grid_timestamp}.jpg"
-                            grid_path = self.cache_dir / grid_filename
-                            
-                            # 创建网格图片
-                            grid_img_path = self.create_image_grid(
-                                saved_image_paths, 
-                                str(grid_path),
-                                grid_size=grid_size, 
-                                gap=4, 
-                                img_size=(800, 800)
-                            )
-                            
-                            if grid_img_path:
-                                # 发送网格图片
-                                with open(grid_img_path, "rb") as f:
-                                    grid_image_data = f.read()
-                                    
-                                # 发送网格图片
-                                await bot.send_image_message(target_id, grid_image_data)
-                                
-                                # 发送提示消息
-                                tip_message = f"我生成了 {len(saved_images)} 张图片，发送「查看图片 序号」即可查看高清大图，例如：查看图片 1"
-                                await bot.send_text_message(target_id, tip_message)
-                                
-                                logger.info(f"已发送网格图片和提示消息给用户 {from_id}")
-                        except Exception as e:
-                            logger.error(f"创建或发送网格图片时出错: {e}")
-                            
-                            # 如果网格图片失败，尝试发送单张图片
-                            try:
-                                # 随机选择一张图片发送
-                                random_img = random.choice(saved_images)
-                                with open(random_img["path"], "rb") as f:
-                                    img_data = f.read()
-                                
-                                await bot.send_image_message(target_id, img_data)
-                                
-                                # 发送提示消息
-                                tip_message = f"我生成了 {len(saved_images)} 张图片，可以发送「查看图片 序号」查看其他图片，例如：查看图片 1"
-                                await bot.send_text_message(target_id, tip_message)
-                                
-                                logger.info(f"已发送单张图片和提示消息给用户 {from_id}")
-                            except Exception as e2:
-                                logger.error(f"发送单张图片时出错: {e2}")
-            
-            # 保存聊天记录
-            await self.save_chat_history(from_id, clean_content, response_text, image_urls, image_details)
-            
-            logger.info(f"豆包任务完成: 回复长度:{len(response_text)}, 图片:{len(image_urls) if image_urls else 0}张")
+            # 交给回复流水线处理
+            ctx = ReplyContext(bot, msg, clean_content, msg.is_at, source="text")
+            await self.run_reply_pipeline(ctx)
             
         except Exception as e:
             logger.error(f"处理消息异常: {str(e)}", exc_info=True)
@@ -916,6 +3575,8 @@ class Doubao(PluginBase):
                     await bot.send_text_message(target_id, error_msg)
             except:
                 pass
+        finally:
+            _request_deadline.reset(deadline_token)
 
     @on_at_message(priority=50)
     async def handle_at_message(self, bot: WechatAPIClient, message: dict):
@@ -926,34 +3587,27 @@ class Doubao(PluginBase):
     @on_quote_message(priority=50)
     async def handle_quote_message(self, bot: WechatAPIClient, message: dict):
         """处理引用消息"""
+        received_at = time.monotonic()
+        deadline_token = _request_deadline.set(None)
         try:
-            logger.debug("==================== 收到引用消息 ====================")
-            logger.debug(f"引用消息详情: {json.dumps(message, ensure_ascii=False)}")
-            
             # 如果插件未启用或引用功能关闭，直接返回
             if not self.enable or not self.enable_quote:
-                logger.debug("插件未启用或引用功能已关闭")
                 return
+            
+            # 完整消息内容只在开启log_message_dump时记录，且只在DEBUG级别生效时序列化
+            if self.log_message_dump:
+                logger.opt(lazy=True).debug("引用消息详情: {}", lambda: json.dumps(message, ensure_ascii=False))
                 
             # 初始化机器人wxid(如果尚未初始化)
             if not self.bot_wxid and not self.initialized_wxid:
                 await self.initialize_bot_wxid(bot)
             
-            # 获取消息基本信息
-            content = str(message.get("Content", "")).strip()
-            from_id = message.get("SenderWxid", message.get("FromWxid", ""))
-            room_id = message["FromWxid"] if message.get("IsGroup") else ""
-            is_group = bool(message.get("IsGroup"))
+            # 解析消息，之后的处理都使用解析结果
+            msg = MessageEnvelope.parse(message, self.bot_wxid, received_at)
+            content, from_id, from_name = msg.content, msg.sender_id, msg.sender_name
+            room_id, is_group = msg.room_id, msg.is_group
             
-            # 获取发送者昵称
-            from_name = message.get("FromName", "")
-            if not from_name and "PushContent" in message:
-                push_content = message["PushContent"]
-                if " : " in push_content:
-                    from_name = push_content.split(" : ")[0]
-            
-            logger.debug(f"引用消息信息 - 发送者: {from_id}({from_name}), 群聊: {is_group}")
-            logger.debug(f"原始消息内容: {content}")
+            logger.debug("引用消息信息 - 发送者: {}({}), 群聊: {}, 内容: {}", from_id, from_name, is_group, content)
             
             # 检查群聊/私聊引用功能开关
             if is_group:
@@ -971,31 +3625,13 @@ class Doubao(PluginBase):
                 return
                 
             # 处理查看图片请求
-            if await self.process_image_request(bot, message, content):
+            if await self.process_image_request(bot, msg):
                 return
             
             # 群聊中检查是否@了机器人（仅当quote_require_at为True时需要检查）
             if is_group and self.quote_require_at:
-                # 检查是否@了机器人
-                is_at_bot = False
-                
-                # 检查不同格式的@标记
-                if "is_at" in message and message["is_at"]:
-                    is_at_bot = True
-                elif "IsAt" in message and message["IsAt"]:
-                    is_at_bot = True
-                elif "AtWxidList" in message and message["AtWxidList"] and self.bot_wxid in message["AtWxidList"]:
-                    is_at_bot = True
-                elif "Ats" in message and message["Ats"] and self.bot_wxid in message["Ats"]:
-                    is_at_bot = True
-                    
-                # 从消息内容解析@信息
-                if not is_at_bot and self.bot_wxid and f"@{self.bot_wxid}" in content:
-                    logger.debug(f"从内容中检测到@机器人ID")
-                    is_at_bot = True
-                
                 # 在群聊中，若设置了quote_require_at，则必须@机器人才处理
-                if not is_at_bot:
+                if not msg.is_at:
                     logger.debug("群聊引用消息未@机器人，且设置了quote_require_at=True，忽略")
                     return
                 
@@ -1016,20 +3652,19 @@ class Doubao(PluginBase):
             for pattern in possible_at_patterns:
                 actual_content = actual_content.replace(pattern, "").strip()
             
-            logger.debug(f"处理后的内容: {actual_content}")
+            logger.debug("处理后的内容: {}", actual_content)
             
             # 获取引用消息内容
-            quote = message.get("Quote", {})
-            logger.debug(f"原始引用数据: {json.dumps(quote, ensure_ascii=False)}")
+            quote = msg.quote or {}
+            if self.log_message_dump:
+                logger.opt(lazy=True).debug("原始引用数据: {}", lambda: json.dumps(quote, ensure_ascii=False))
             
             quote_content = quote.get("Content", "")
             quote_type = quote.get("MsgType", 0)
             quote_msg_id = quote.get("MsgId", "")
             quote_nickname = quote.get("Nickname", "")
             
-            logger.debug(f"引用内容: {quote_content}")
-            logger.debug(f"引用类型: {quote_type}")
-            logger.debug(f"引用发送者: {quote_nickname}")
+            logger.debug("引用内容: {}, 类型: {}, 发送者: {}", quote_content, quote_type, quote_nickname)
             
             # 组合提示词 - 确保引用内容优先传递给豆包AI
             prompt = ""
@@ -1064,174 +3699,17 @@ class Doubao(PluginBase):
                 
             logger.info(f"开始处理引用消息 - From: {from_id}, 组合后的提示词: {prompt}")
             
-            # 检查用户是否超出每日限制
-            if not await self.check_user_limit(from_id):
-                logger.debug(f"用户 {from_id} 超出每日限制")
-                target_id = room_id if is_group else from_id
-                await bot.send_text_message(target_id, "您今日的对话次数已达上限，请明天再来吧~")
-                return
-                
-            # 调用豆包AI
-            logger.debug("开始调用豆包AI(引用消息)")
-            response_text, image_urls = await self.chat_with_doubao(prompt)
-            logger.debug(f"豆包AI返回(引用消息) - 文本长度: {len(response_text) if response_text else 0}, 图片数: {len(image_urls)}")
-            
-            # 记录图片URL信息，用于调试
-            if image_urls:
-                logger.info(f"引用消息获取到{len(image_urls)}张图片URL")
-                for i, url in enumerate(image_urls):
-                    logger.debug(f"引用消息图片 #{i+1} URL: {url[:100]}{'...' if len(url) > 100 else ''}")
-            else:
-                logger.info("引用消息未获取到任何图片URL")
-            
-            # 图片详细信息，在处理图片后填充
-            image_details = []
-            
-            # 确定发送目标
-            target_id = room_id if is_group else from_id
-            
-            # 发送回复文本
-            if response_text:
-                if is_group:
-                    # 使用专用的@消息API
-                    try:
-                        await bot.send_at_message(target_id, response_text, [from_id])
-                        logger.info(f"发送@回复成功 - To: {target_id}, At: {from_id}")
-                    except Exception as e:
-                        logger.error(f"发送@回复失败: {e}")
-                        # 尝试普通文本发送
-                        await bot.send_text_message(target_id, f"@{from_name} {response_text}")
-                else:
-                    await bot.send_text_message(target_id, response_text)
-                    logger.info(f"发送文本回复成功 - To: {target_id}")
-            
-            # 处理图片 - 如果有图片，保存并创建网格图片
-            if image_urls:
-                saved_images = []
-                saved_image_paths = []
-                
-                # 下载并保存所有图片
-                for i, img_url in enumerate(image_urls):
-                    try:
-                        # 下载图片
-                        image_data = await self.download_image(img_url)
-                        if image_data:
-                            # 生成文件名
-                            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-                            random_str = ''.join(random.choices('abcdefghijklmnopqrstuvwxyz0123456789', k=8))
-                            image_path = self.cache_dir / f"doubao_img_{timestamp}_{random_str}_{i+1}.jpg"
-                            
-                            # 保存图片
-                            with open(image_path, "wb") as f:
-                                f.write(image_data)
-                                
-                            # 记录图片信息
-                            image_info = {
-                                "number": i + 1,
-                                "path": str(image_path),
-                                "url": img_url,
-                                "description": f"图片 #{i+1}"
-                            }
-                            
-                            saved_images.append(image_info)
-                            saved_image_paths.append(str(image_path))
-                            # 添加到详细信息列表
-                            image_details.append(image_info)
-                            logger.debug(f"保存图片 #{i+1}: {image_path}")
-                    except Exception as e:
-                        logger.error(f"处理图片 #{i+1} 时出错: {e}")
-                
-                # 调用清理缓存方法，保留最新的25张图片
-                await self.clean_image_cache(25)
-                
-                # 缓存用户的图片信息
-                if saved_images:
-                    self.image_cache[from_id] = saved_images
-                    
-                    # 只有一张图片时，直接发送高清图片
-                    if len(saved_images) == 1:
-                        try:
-                            # 读取图片数据
-                            image_path = saved_images[0]["path"]
-                            with open(image_path, "rb") as f:
-                                image_data = f.read()
-                            
-                            # 发送单张图片
-                            await bot.send_image_message(target_id, image_data)
-                            logger.info(f"已发送单张高清图片给用户 {from_id}")
-                        except Exception as e:
-                            logger.error(f"发送单张图片时出错: {e}")
-                    # 多张图片时，创建网格图片
-                    else:
-                        try:
-                            # 计算合适的网格大小
-                            n_images = len(saved_image_paths)
-                            if n_images <= 2:
-                                grid_size = (n_images, 1)  # 1行，n列
-                            elif n_images <= 4:
-                                grid_size = (2, 2)  # 2行2列
-                            elif n_images <= 6:
-                                grid_size = (3, 2)  # 2行3列
-                            elif n_images <= 9:
-                                grid_size = (3, 3)  # 3行3列
-                            else:
-                                grid_size = (4, (n_images + 3) // 4)  # 4列，行数根据图片数量计算
-                                
-                            # 生成网格图片文件名
-                            grid_timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-                            grid_filename = f"doubao_grid_{grid_timestamp}.jpg"
-                            grid_path = self.cache_dir / grid_filename
-                            
-                            # 创建网格图片
-                            grid_img_path = self.create_image_grid(
-                                saved_image_paths, 
-                                str(grid_path),
-                                grid_size=grid_size, 
-                                gap=4, 
-                                img_size=(800, 800)
-                            )
-                            
-                            if grid_img_path:
-                                # 发送网格图片
-                                with open(grid_img_path, "rb") as f:
-                                    grid_image_data = f.read()
-                                    
-                                # 发送网格图片
-                                await bot.send_image_message(target_id, grid_image_data)
-                                
-                                # 发送提示消息
-                                tip_message = f"我生成了 {len(saved_images)} 张图片，请注意每张图片右上角有【醒目大号】序号，发送「查看图片 序号」即可查看高清大图，例如：查看图片 1"
-                                await bot.send_text_message(target_id, tip_message)
-                                
-                                logger.info(f"已发送网格图片和提示消息给用户 {from_id}")
-                        except Exception as e:
-                            logger.error(f"创建或发送网格图片时出错: {e}")
-                            
-                            # 如果网格图片失败，尝试发送单张图片
-                            try:
-                                # 随机选择一张图片发送
-                                random_img = random.choice(saved_images)
-                                with open(random_img["path"], "rb") as f:
-                                    img_data = f.read()
-                                
-                                await bot.send_image_message(target_id, img_data)
-                                
-                                # 发送提示消息
-                                tip_message = f"我生成了 {len(saved_images)} 张图片，可以发送「查看图片 序号」查看其他图片，例如：查看图片 1"
-                                await bot.send_text_message(target_id, tip_message)
-                                
-                                logger.info(f"已发送单张图片和提示消息给用户 {from_id}")
-                            except Exception as e2:
-                                logger.error(f"发送单张图片时出错: {e2}")
-            
-            # 保存聊天记录
-            await self.save_chat_history(from_id, prompt, response_text, image_urls, image_details)
+            # 交给回复流水线处理，群聊中@引用者回复
+            ctx = ReplyContext(bot, msg, prompt, is_group, source="quote")
+            await self.run_reply_pipeline(ctx)
             
         except Exception as e:
             logger.error(f"处理引用消息时发生异常: {str(e)}", exc_info=True)
             target_id = room_id if is_group else from_id
             error_msg = f"@{from_name} 抱歉，处理引用消息时出现错误" if is_group else "抱歉，处理引用消息时出现错误"
             await bot.send_text_message(target_id, error_msg)
+        finally:
+            _request_deadline.reset(deadline_token)
 
     async def initialize_bot_wxid(self, bot):
         """初始化机器人wxid"""
@@ -1274,162 +3752,73 @@ class Doubao(PluginBase):
                 # 无论是否成功，都标记为已初始化，避免重复尝试
                 self.initialized_wxid = True 
                 
-    def create_image_grid(self, image_files, output_path, grid_size=(2, 2), gap=4, background_color=(255, 255, 255), img_size=(800, 800)):
-        """
-        创建高质量图片网格，模拟豆包网站的图片展示布局
-
-        参数:
+    async def create_image_grid_async(self, image_files, output_path, **kwargs):
+        """在渲染工作池中创建图片网格，避免阻塞事件循环
+        
+        Args:
             image_files: 图片文件路径列表
             output_path: 输出的网格图片路径
-            grid_size: 网格大小(列数, 行数)
-            gap: 图片间距（像素）
-            background_color: 背景颜色
-            img_size: 单个图片的尺寸，默认(800, 800)以获得更高清的效果
-
-        返回:
+            **kwargs: 传递给render_image_grid的其他参数
+            
+        Returns:
             生成的网格图片路径
         """
-        if not image_files:
-            return None
-
-        # 计算网格尺寸
-        n_images = len(image_files)
-        cols, rows = grid_size
-
-        # 确保网格能容纳所有图片
-        while cols * rows < n_images:
-            if cols <= rows:
-                cols += 1
-            else:
-                rows += 1
-
-        # 加载所有图片并调整大小
-        images = []
-        img_width, img_height = img_size
-
-        for img_path in image_files:
-            try:
-                img = Image.open(img_path)
-                # 保持宽高比缩放到统一大小
-                img = img.resize((img_width, img_height), Image.LANCZOS)
-                images.append(img)
-            except Exception as e:
-                logger.error(f"无法加载图片 {img_path}: {str(e)}")
-
-        if not images:
-            return None
-
-        # 计算网格图片大小
-        grid_width = cols * img_width + (cols - 1) * gap
-        grid_height = rows * img_height + (rows - 1) * gap
-
-        # 创建白色背景画布
-        grid_img = Image.new('RGB', (grid_width, grid_height), background_color)
-
-        # 放置图片到网格
-        for i, img in enumerate(images):
-            if i >= cols * rows:
-                break  # 超出网格容量
-
-            row = i // cols
-            col = i % cols
-
-            x = col * (img_width + gap)
-            y = row * (img_height + gap)
+        # 排队任务过多时直接放弃网格渲染，由调用方回退到发送单张图片
+        if self._render_pending >= self.render_workers + self.render_queue_size:
+            raise RuntimeError(f"网格渲染队列已满，当前任务数: {self._render_pending}")
+        
+        # 超过处理时限时放弃渲染，尚未开始的渲染任务会被取消
+        timeout = time_left()
+        if timeout is not None and timeout <= 0:
+            raise RuntimeError("已超过处理时限，放弃网格渲染")
+        
+        kwargs.setdefault("quality", self.grid_jpeg_quality)
+        self._render_pending += 1
+        start = time.monotonic()
+        try:
+            grid_path = await asyncio.wait_for(
+                self.run_in_render_pool(functools.partial(render_image_grid, image_files, output_path, **kwargs)),
+                timeout
+            )
+            if grid_path:
+                self.grid_file_cache.add_file(grid_path)
+            return grid_path
+        finally:
+            self._render_pending -= 1
+            self.metrics.observe("doubao_grid_render_seconds", time.monotonic() - start)
 
-            # 粘贴图片到位置
-            grid_img.paste(img, (x, y))
+    async def run_in_render_pool(self, func, *args):
+        """在渲染工作池(线程池或进程池)中执行同步的图像处理函数
+        
+        Args:
+            func: 同步函数，使用进程池时必须可被pickle
+            *args: 函数参数
             
-            # 在右上角添加序号
-            try:
-                # 绘制上下文
-                draw = ImageDraw.Draw(grid_img)
-                
-                # 序号文本
-                number_text = str(i + 1)
-                
-                # 设置字体大小 - 大幅增大字体尺寸
-                font_size = int(img_width / 5)  # 从1/8增加到1/5
-                # 确保字体大小在合理范围内
-                font_size = max(100, min(font_size, 350))  # 最小100px，最大350px
-                
-                # 尝试加载字体
-                try:
-                    # 尝试加载微软雅黑
-                    font = ImageFont.truetype("msyh.ttc", font_size)
-                except:
-                    try:
-                        # 尝试加载Arial
-                        font = ImageFont.truetype("arial.ttf", font_size)
-                    except:
-                        # 使用默认字体
-                        font = ImageFont.load_default()
-                
-                # 计算文本尺寸
-                try:
-                    # PIL 9.0.0及以上版本
-                    text_bbox = draw.textbbox((0, 0), number_text, font=font)
-                    text_width = text_bbox[2] - text_bbox[0]
-                    text_height = text_bbox[3] - text_bbox[1]
-                except:
-                    # 旧版本PIL
-                    text_width, text_height = draw.textsize(number_text, font=font)
-                
-                # 计算文本位置 - 右上角
-                padding_x = max(10, int(font_size / 8))  # 减小水平间距
-                padding_y = max(10, int(font_size / 8))  # 减小垂直间距
-                text_x = x + img_width - text_width - padding_x
-                text_y = y + padding_y
-                
-                # 绘制背景
-                # 极小的背景内边距，让数字几乎充满整个背景框
-                bg_padding = max(2, int(font_size / 20))  # 极小内边距
-                bg_x0 = text_x - bg_padding
-                bg_y0 = text_y - bg_padding
-                bg_x1 = text_x + text_width + bg_padding
-                bg_y1 = text_y + text_height + bg_padding
-                
-                # 添加黑色边框和白色背景
-                # 增加边框粗细，提高视觉对比度
-                border_width = 3  # 增加到3px
-                draw.rectangle([bg_x0-border_width, bg_y0-border_width, bg_x1+border_width, bg_y1+border_width], fill=(0, 0, 0))
-                draw.rectangle([bg_x0, bg_y0, bg_x1, bg_y1], fill=(255, 255, 255))
-                
-                # 绘制序号文字 - 使用稍微加粗的效果
-                # 通过在略微偏移位置多次绘制实现视觉上的加粗效果
-                for offset in range(1):
-                    for dx, dy in [(0,0), (1,0), (0,1), (1,1)]:
-                        draw.text((text_x+dx, text_y+dy), number_text, fill=(0, 0, 0), font=font)
-                
-            except Exception as e:
-                logger.error(f"绘制序号时出错: {e}")
-                # 备用方案
-                try:
-                    backup_font_size = max(img_width // 8, 60)
-                    draw.text((x + img_width - 60, y + 20), number_text, fill=(0, 0, 0))
-                except:
-                    logger.error("备用序号绘制也失败")
-
-        # 保存网格图片
-        grid_img.save(output_path)
-        return output_path
+        Returns:
+            函数返回值
+        """
+        if self._render_executor is None:
+            if self.render_executor_type == "process":
+                self._render_executor = ProcessPoolExecutor(max_workers=self.render_workers)
+            else:
+                self._render_executor = ThreadPoolExecutor(max_workers=self.render_workers, thread_name_prefix="doubao_render")
+            logger.info(f"已创建图片渲染工作池: {self.render_executor_type}, 工作数{self.render_workers}")
+        
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._render_executor, func, *args)
 
-    async def process_image_request(self, bot: WechatAPIClient, message: dict, content: str):
+    async def process_image_request(self, bot: WechatAPIClient, msg: MessageEnvelope):
         """处理查看图片的请求
         
         Args:
             bot: 微信API客户端
-            message: 消息对象
-            content: 消息内容
+            msg: 解析后的消息
         
         Returns:
             bool: 是否处理了图片请求
         """
-        # 提取发送者和目标ID
-        from_id = message.get("SenderWxid", message.get("FromWxid", ""))
-        room_id = message["FromWxid"] if message.get("IsGroup") else ""
-        is_group = bool(room_id)
-        target_id = room_id if is_group else from_id
+        content = msg.content
+        from_id, room_id, target_id = msg.sender_id, msg.room_id, msg.target_id
         
         # 检查是否是查看图片请求
         if "查看图片" in content:
@@ -1444,26 +3833,25 @@ class Doubao(PluginBase):
                     if numbers:
                         image_number = int(numbers[0])
                         
-                        # 检查用户是否有缓存的图片
-                        if from_id in self.image_cache:
-                            user_images = self.image_cache[from_id]
+                        # 获取用户在当前群(或私聊)中最近一次生成的图片
+                        user_images = self.image_selections.get(from_id, room_id)
+                        if user_images:
                             # 检查序号是否有效
                             if 1 <= image_number <= len(user_images):
-                                # 获取图片信息
+                                # 获取图片信息，文件已被缓存淘汰时重新下载
                                 image_info = user_images[image_number - 1]
-                                image_path = image_info["path"]
-                                image_desc = image_info["description"]
+                                image_path = await self.ensure_image_file(image_info)
                                 
                                 logger.info(f"用户 {from_id} 请求查看图片 #{image_number}")
                                 
+                                if not image_path:
+                                    await bot.send_text_message(target_id, f"抱歉，图片 #{image_number} 已过期，请重新生成")
+                                    return True
+                                
                                 # 发送图片
                                 try:
-                                    # 读取图片数据
-                                    with open(image_path, "rb") as f:
-                                        image_data = f.read()
-                                    
                                     # 发送图片
-                                    await bot.send_image_message(target_id, image_data)
+                                    await self.send_image_reply(bot, target_id, image_path)
                                     
                                     logger.info(f"已发送图片 #{image_number} 给用户 {from_id}")
                                     return True
@@ -1484,49 +3872,37 @@ class Doubao(PluginBase):
                 
         return False 
 
-    async def clean_image_cache(self, max_images=25):
-        """清理图片缓存，保留最新的max_images张图片
+    async def ensure_image_file(self, image_info: dict) -> str:
+        """确保图片文件仍在缓存中，已被淘汰时按原URL重新下载
         
         Args:
-            max_images: 最大保留图片数量
+            image_info: 图片信息，重新下载后会更新其中的路径
+            
+        Returns:
+            str: 图片文件路径，无法恢复时返回None
+        """
+        if os.path.exists(image_info["path"]):
+            return image_info["path"]
+        
+        logger.info(f"图片文件已被清理，重新下载: {image_info['description']}")
+        saved_images = await self.download_images([image_info["url"]])
+        if not saved_images:
+            return None
+        image_info["path"] = saved_images[0]["path"]
+        self.image_selections.mark_dirty()
+        return image_info["path"]
+
+    async def clean_image_cache(self):
+        """扫描缓存目录建立图片缓存索引，并删除超出数量和空间限制的旧图片
+        
+        之后新图片加入缓存时会逐个淘汰旧图片，不需要再扫描目录。
         """
         try:
-            # 获取cache目录下的所有jpg文件
-            image_files = list(self.cache_dir.glob("doubao_img_*.jpg"))
-            
-            # 根据修改时间进行排序（最旧的在前面）
-            image_files.sort(key=lambda x: x.stat().st_mtime)
+            # 删除上次运行中断时留下的临时下载文件
+            for temp_path in self.cache_dir.glob("doubao_tmp_*.part"):
+                temp_path.unlink(missing_ok=True)
             
-            # 计算需要删除的文件数量
-            files_to_delete = len(image_files) - max_images
-            
-            if files_to_delete > 0:
-                logger.info(f"缓存图片数量超过{max_images}张，准备删除{files_to_delete}张最旧的图片")
-                
-                # 删除最旧的文件
-                for i in range(files_to_delete):
-                    try:
-                        image_files[i].unlink()
-                        logger.debug(f"删除缓存图片: {image_files[i]}")
-                    except Exception as e:
-                        logger.error(f"删除缓存图片失败: {e}")
-            
-            # 同时清理网格图片，保留最新的10张
-            grid_files = list(self.cache_dir.glob("doubao_grid_*.jpg"))
-            grid_files.sort(key=lambda x: x.stat().st_mtime)
-            
-            # 计算需要删除的网格图片数量
-            grid_files_to_delete = len(grid_files) - 10
-            
-            if grid_files_to_delete > 0:
-                logger.info(f"网格图片数量超过10张，准备删除{grid_files_to_delete}张最旧的网格图片")
-                
-                # 删除最旧的网格图片
-                for i in range(grid_files_to_delete):
-                    try:
-                        grid_files[i].unlink()
-                        logger.debug(f"删除网格图片: {grid_files[i]}")
-                    except Exception as e:
-                        logger.error(f"删除网格图片失败: {e}")
+            await self.image_file_cache.load()
+            await self.grid_file_cache.load()
         except Exception as e:
-            logger.error(f"清理图片缓存时出错: {e}") 
+            logger.error(f"清理图片缓存时出错: {e}")